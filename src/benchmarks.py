@@ -0,0 +1,77 @@
+"""Offline parser benchmark over the saved pages in fixtures/.
+
+    python benchmarks.py [iterations]
+
+Prints time and peak allocations per parse for every page type and parser backend.
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+# options.py wants the bot environment, parsing does not use any of it
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("PROXY", "socks5://127.0.0.1:1080")
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/benchmark")
+
+from bs4 import BeautifulSoup
+
+from flibusta import BookPage, AuthorPage, SearchPage
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+PAGES = [
+    ("book_531326.html", BookPage),
+    ("book_nonexistent.html", BookPage),
+    ("author_18862.html", AuthorPage),
+    ("author_10463.html", AuthorPage),
+    ("author_nonexistent.html", AuthorPage),
+    ("search_chekhov.html", SearchPage),
+    ("search_empty.html", SearchPage),
+]
+
+PARSERS = {
+    # the whole document as a soup, how pages were parsed before from_html
+    "soup-full": lambda page_cls, html: page_cls(BeautifulSoup(html, "lxml")),
+    "soup": lambda page_cls, html: page_cls.from_html(html, backend="soup"),
+    "lxml": lambda page_cls, html: page_cls.from_html(html, backend="lxml"),
+}
+
+
+def load_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as file:
+        return file.read()
+
+
+def measure_time(parse, page_cls, html: bytes, iterations: int) -> float:
+    """Milliseconds per parse."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse(page_cls, html)
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def measure_allocations(parse, page_cls, html: bytes) -> float:
+    """Peak KiB allocated by python during one parse."""
+    tracemalloc.start()
+    try:
+        parse(page_cls, html)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f"{'page':<26}{'size KiB':>10}{'parser':>12}{'ms/parse':>12}{'peak KiB':>12}")
+    for name, page_cls in PAGES:
+        html = load_fixture(name)
+        for parser_name, parse in PARSERS.items():
+            ms = measure_time(parse, page_cls, html, iterations)
+            peak = measure_allocations(parse, page_cls, html)
+            print(f"{name:<26}{len(html) / 1024:>10.1f}{parser_name:>12}{ms:>12.2f}{peak:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
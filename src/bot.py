@@ -1,23 +1,55 @@
 import asyncio
-import gc
 import logging
+import multiprocessing
+import signal
+import time
+from typing import Optional
 
 from aiogram import Bot, Dispatcher
 from aiogram.exceptions import TelegramBadRequest
-from aiogram.filters import CommandStart
-from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram.filters import Command, CommandObject, CommandStart, ExceptionTypeFilter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import Message, CallbackQuery, ErrorEvent, InlineQuery, InputFile, FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardButton, InlineKeyboardMarkup, InlineKeyboardBuilder
-from aiohttp import ClientError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from cachetools import TTLCache
+from sqlalchemy.exc import SQLAlchemyError
 
-from db import UserMiddleware, init_db
-from flibusta import Flibusta, BookPage
-from options import BOT_TOKEN, MESSAGE_LIMIT, CAPTION_LIMIT
+from cache import FileCache
+from db import UserMiddleware, engine, init_db, file_uses, get_file_id, save_file_id, forget_file_id, get_popular_books, pool_status
+from flibusta import Flibusta, BookFormat, BookPage, DownloadedFile, FileTooBigException, PaginatedPage, UpstreamError
+from inline import InlineSearch, inline_results
+from memory import MemoryProfiler, rss_bytes
+from metrics import registry, book_sends, start_metrics_server, HandlerMetricsMiddleware, TelegramMetricsMiddleware
+from prefetch import Prefetcher
+from scheduler import Priority
+from options import BOT_TOKEN, MESSAGE_LIMIT, CAPTION_LIMIT, METRICS_HOST, METRICS_PORT, CACHE_BOOK_TTL
 from options import TELEGRAM_LIMIT_KILOS, TELEGRAM_LIMIT_BYTES, TELEGRAM_LIMIT_MB
+from options import ADMIN_IDS, CATALOGUE_REFRESH_INTERVAL, INLINE_CACHE_TIME, WARMUP_BOOKS, WARMUP_DAYS
+from options import BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEB_WORKERS
+from storage import shared_storage
+
+# telegram errors that mean a stored file_id can't be sent anymore
+INVALID_FILE_ID_ERRORS = ("file identifier", "file_id", "file reference", "file_reference")
+UPSTREAM_ERROR_TEXT = 'Проблема с подключением к флибусте, попробуйте немного позже'
+BOOK_TOO_BIG_TEXT = f'Книга слишком большая (больше {TELEGRAM_LIMIT_MB} МБ) и его невозможно передать через Telegram API. Попробуйте найти другую версию книги.'
 
 bot = Bot(token=BOT_TOKEN)
+bot.session.middleware(TelegramMetricsMiddleware())
 dp = Dispatcher()
 middleware = UserMiddleware()
 dp.update.outer_middleware(middleware)
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.inline_query.middleware(HandlerMetricsMiddleware())
+file_cache = FileCache()
+profiler = MemoryProfiler()
+inline_search = InlineSearch()
+prefetcher = Prefetcher()
+background_tasks: set[asyncio.Task] = set()
+# book id -> title, the name of the downloaded file; a miss falls back to the book page
+book_names = TTLCache(maxsize=10000, ttl=CACHE_BOOK_TTL)
 logger = logging.getLogger("Bot logger")
 logger.setLevel(logging.INFO)
 console_handler = logging.StreamHandler()
@@ -26,11 +58,79 @@ formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(messag
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+def register_metrics():
+    # state that is already counted elsewhere, read on every scrape
+    registry.callback("flibusta_cache_hits_total", "Page cache hits", lambda: Flibusta.cache.hits, kind="counter")
+    registry.callback("flibusta_cache_misses_total", "Page cache misses", lambda: Flibusta.cache.misses, kind="counter")
+    registry.callback("flibusta_shared_cache_hits_total", "Pages found in the shared storage", lambda: Flibusta.cache.shared_hits, kind="counter")
+    registry.callback("catalogue_hits_total", "Searches answered by the local catalogue", lambda: Flibusta.catalogue.hits, kind="counter")
+    registry.callback("catalogue_misses_total", "Searches the local catalogue had no results for", lambda: Flibusta.catalogue.misses, kind="counter")
+    registry.callback("inline_superseded_total", "Inline queries dropped because the user typed on", lambda: inline_search.superseded, kind="counter")
+    registry.callback("inline_timeouts_total", "Inline queries out of the latency budget", lambda: inline_search.timeouts, kind="counter")
+    registry.callback("inline_prefix_hits_total", "Inline queries answered from earlier results", lambda: inline_search.prefix_hits, kind="counter")
+    registry.callback("flibusta_upstream_prefetching", "Prefetches in progress", lambda: Flibusta.scheduler.active_by_priority[Priority.PREFETCH])
+    registry.callback("flibusta_cache_entries", "Pages in the cache", lambda: len(Flibusta.cache))
+    registry.callback("flibusta_coalesced_total", "Requests that joined one already in flight", lambda: Flibusta.inflight.shared, kind="counter")
+    registry.callback("flibusta_upstream_active", "Requests to flibusta in progress", lambda: Flibusta.scheduler.active)
+    registry.callback("flibusta_upstream_waiting", "Requests waiting for a scheduler slot", lambda: Flibusta.scheduler.waiting)
+    registry.callback("flibusta_parse_queue_depth", "Pages waiting for or being parsed", lambda: Flibusta.parser.queue_depth)
+    registry.callback("bot_users_queued", "Users waiting to be saved to the database", lambda: len(middleware.queue))
+    registry.callback(
+        "flibusta_mirror_latency_seconds", "Average page latency of a mirror",
+        lambda: {mirror.url: mirror.latency or 0 for mirror in Flibusta.mirrors.mirrors(Flibusta.url)}, labels=("mirror",),
+    )
+    registry.callback(
+        "flibusta_mirror_up", "1 for a healthy mirror, 0 for one put aside after failures",
+        lambda: {mirror.url: int(mirror.healthy) for mirror in Flibusta.mirrors.mirrors(Flibusta.url)}, labels=("mirror",),
+    )
+    registry.callback("process_resident_memory_bytes", "Resident memory size", rss_bytes)
+    registry.callback(
+        "db_pool", "Database pool state and counters", pool_status, labels=("stat",),
+    )
+
+register_metrics()
+
+class DownloadInputFile(InputFile):
+    """Uploads a spooled download to telegram chunk by chunk, without copying it into bytes."""
+
+    def __init__(self, file: DownloadedFile, filename: str):
+        super().__init__(filename=filename)
+        self.file = file
+
+    async def read(self, bot: Bot):
+        for chunk in self.file.chunks(self.chunk_size):
+            yield chunk
+
+class PageCallback(CallbackData, prefix="page"):
+    # link of the author page, or "search" for the query the bot message replies to
+    link: str
+    page: int
+
+class DownloadCallback(CallbackData, prefix="d"):
+    # d:531326:1 fits telegram's 64 bytes for any book id
+    book_id: int
+    book_format: BookFormat
+
+def get_pagination_markup(link: str, page: int, result: PaginatedPage) -> InlineKeyboardMarkup | None:
+    if result.pages_count == 1:
+        return None
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.add(InlineKeyboardButton(text="« назад", callback_data=PageCallback(link=link, page=page - 1).pack()))
+    if page < result.pages_count - 1:
+        builder.add(InlineKeyboardButton(text="вперёд »", callback_data=PageCallback(link=link, page=page + 1).pack()))
+    return builder.as_markup()
+
 def get_download_markup(book_page: BookPage) -> InlineKeyboardMarkup:
     result = InlineKeyboardBuilder()
     for link in book_page.links:
         _format = link.split('/')[-1]
-        button = InlineKeyboardButton(text=_format, callback_data=link)
+        if _format in BookFormat.__members__:
+            callback_data = DownloadCallback(book_id=book_page.num, book_format=BookFormat[_format]).pack()
+        else:
+            # a format we don't know yet, the raw /b/123/xyz link still works
+            callback_data = link
+        button = InlineKeyboardButton(text=_format, callback_data=callback_data)
         result.add(button)
     return result.as_markup()
 
@@ -39,9 +139,22 @@ async def start_handler(msg: Message):
     logger.info(f"/start from {msg.from_user.username} with id {msg.from_user.id}")
     await msg.answer("Напиши название книги или фамилию автора.")
 
+@dp.message(Command("memory"), lambda msg: msg.from_user.id in ADMIN_IDS)
+async def memory_handler(msg: Message, command: CommandObject):
+    # /memory objects also counts live objects by type, which walks the whole heap
+    report = await asyncio.to_thread(profiler.report, objects=command.args == "objects")
+    await msg.answer(report[:MESSAGE_LIMIT])
+    logger.info(f"Admin {msg.from_user.username} {msg.from_user.id} got a memory report")
+
+@dp.message(Command("memory"))
+async def memory_denied_handler(msg: Message):
+    # not an admin: answer here, otherwise /memory would go to flibusta as a search
+    await msg.answer("Команда доступна только администраторам.")
+    logger.info(f"User {msg.from_user.username} {msg.from_user.id} has requested a memory report")
+
 @dp.message(lambda msg: msg.text.startswith("/b_"))
 async def book_handler(msg: Message):
-    book_page = await Flibusta.get_page(msg.text)
+    book_page = await Flibusta.get_page(msg.text, user_id=msg.from_user.id)
     if book_page.name == book_page.doesnt_exist:
         await bot.send_message(
             chat_id=msg.chat.id,
@@ -52,11 +165,12 @@ async def book_handler(msg: Message):
     if book_page.size >= TELEGRAM_LIMIT_KILOS:
         await bot.send_message(
             chat_id=msg.chat.id,
-            text=f'Книга слишком большая (больше {TELEGRAM_LIMIT_MB} МБ) и его невозможно передать через Telegram API. Попробуйте найти другую версию книги.',
+            text=BOOK_TOO_BIG_TEXT,
         )
         logger.info(f"User {msg.from_user.username} {msg.from_user.id} has requested too big book (book_handler_func)")
         return
     markup = get_download_markup(book_page)
+    book_names[book_page.num] = book_page.name
     text = book_page.text()
     if book_page.cover_link:
         try:
@@ -65,11 +179,12 @@ async def book_handler(msg: Message):
             await bot.send_message(msg.chat.id, text=text[:MESSAGE_LIMIT], reply_markup=markup)
     else:
         await bot.send_message(msg.chat.id, text=text[:MESSAGE_LIMIT], reply_markup=markup)
+    prefetcher.prefetch_formats(book_page, user_id=msg.from_user.id)
     logger.info(f"User {msg.from_user.username} {msg.from_user.id} got his {msg.text} book")
 
 @dp.message(lambda msg: msg.text.startswith("/a_"))
 async def author_handler(msg: Message):
-    author_obj = await Flibusta.get_page(msg.text)
+    author_obj = await Flibusta.get_page(msg.text, user_id=msg.from_user.id)
     if author_obj.name == author_obj.doesnt_exist:
         await bot.send_message(
             chat_id=msg.chat.id,
@@ -77,15 +192,40 @@ async def author_handler(msg: Message):
         )
         logger.info(f"User {msg.from_user.username} {msg.from_user.id} has requested nonexistent author")
         return
-    await msg.answer(text=author_obj.text()[:MESSAGE_LIMIT])
+    markup = get_pagination_markup(msg.text, 0, author_obj)
+    await msg.answer(text=author_obj.text()[:MESSAGE_LIMIT], reply_markup=markup)
+    prefetcher.prefetch_links(author_obj.page_links(0), user_id=msg.from_user.id)
     logger.info(f"User {msg.from_user.username} {msg.from_user.id} got his {msg.text} author")
 
 @dp.message()
 async def search_handler(msg: Message):
-    result = (await Flibusta.get_search_text(msg.text)).text()
-    await msg.reply(result[:MESSAGE_LIMIT])
+    search_page = await Flibusta.get_search_text(msg.text, user_id=msg.from_user.id)
+    markup = get_pagination_markup("search", 0, search_page)
+    await msg.reply(search_page.text()[:MESSAGE_LIMIT], reply_markup=markup)
+    prefetcher.prefetch_links(search_page.page_links(0), user_id=msg.from_user.id)
     logger.info(f"User {msg.from_user.username} {msg.from_user.id} got his {msg.text} response")
 
+@dp.inline_query()
+async def inline_search_handler(query: InlineQuery):
+    text = query.query.strip()
+    if len(text) < inline_search.min_query:
+        await query.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+    try:
+        search_page = await inline_search.search(text, user_id=query.from_user.id)
+    except (asyncio.TimeoutError, UpstreamError):
+        # flibusta is slow or down, don't let telegram cache the empty answer
+        await query.answer([], cache_time=0, is_personal=True)
+        logger.info(f"User {query.from_user.username} {query.from_user.id} inline {text} is out of time")
+        return
+    if search_page is None:
+        # the user has typed on, the newer query answers
+        return
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    results, next_offset = inline_results(search_page, offset)
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+    logger.info(f"User {query.from_user.username} {query.from_user.id} got inline {text} response")
+
 async def message_or_caption_editor(msg:Message, text: str, markup=None) -> str:
     if msg.caption:
         await bot.edit_message_caption(chat_id=msg.chat.id, message_id=msg.message_id, caption=text, reply_markup=markup)
@@ -94,55 +234,268 @@ async def message_or_caption_editor(msg:Message, text: str, markup=None) -> str:
         await bot.edit_message_text(chat_id=msg.chat.id, message_id=msg.message_id, text=text, reply_markup=markup)
         return msg.text
 
-@dp.callback_query()
-async def download_book_handler(call: CallbackQuery):
-    full_url = f"{Flibusta.url}{call.data}"
+@dp.callback_query(PageCallback.filter())
+async def page_handler(call: CallbackQuery, callback_data: PageCallback):
+    # pages come from the page cache, so turning them usually doesn't touch flibusta
+    if callback_data.link == "search":
+        query = call.message.reply_to_message and call.message.reply_to_message.text
+        if not query:
+            await call.answer("Повторите поиск")
+            return
+        result = await Flibusta.get_search_text(query, user_id=call.from_user.id)
+    else:
+        result = await Flibusta.get_page(callback_data.link, user_id=call.from_user.id)
+    page = min(callback_data.page, result.pages_count - 1)
+    markup = get_pagination_markup(callback_data.link, page, result)
+    try:
+        await call.message.edit_text(text=result.text(page)[:MESSAGE_LIMIT], reply_markup=markup)
+    except TelegramBadRequest:
+        # double click, the message already shows this page
+        pass
+    await call.answer()
+    prefetcher.prefetch_links(result.page_links(page), user_id=call.from_user.id)
+    logger.info(f"User {call.from_user.username} {call.from_user.id} got page {page} of {callback_data.link}")
+
+def is_invalid_file_id(error: TelegramBadRequest) -> bool:
+    message = error.message.lower()
+    return any(reason in message for reason in INVALID_FILE_ID_ERRORS)
+
+async def send_cached_book(call: CallbackQuery, book_id: int, book_format: str) -> bool:
+    try:
+        file_id = await get_file_id(book_id, book_format)
+    except (SQLAlchemyError, OSError):
+        # downloads work without the database, it only saves an upload
+        logger.exception(f"Can't look up the file_id of /b/{book_id}/{book_format}")
+        return False
+    if file_id is None:
+        return False
+    try:
+        await bot.send_document(call.message.chat.id, file_id)
+    except TelegramBadRequest as error:
+        if not is_invalid_file_id(error):
+            # the file_id is fine, an upload would fail the same way
+            raise
+        # file_id is not valid anymore, upload the book again
+        try:
+            await forget_file_id(book_id, book_format)
+        except (SQLAlchemyError, OSError):
+            logger.exception(f"Can't forget the file_id of /b/{book_id}/{book_format}")
+        return False
+    await call.answer()
+    file_uses.record(book_id, book_format)
+    logger.info(f"User {call.from_user.username} {call.from_user.id} got his /b/{book_id}/{book_format} book from telegram cache")
+    book_sends.inc(source="file_id")
+    return True
+
+async def get_book_name(book_id: int, user_id: int) -> str:
+    name = book_names.get(book_id)
+    if name is None:
+        # shown before a restart or by another worker, the page is usually still cached
+        book_page = await Flibusta.get_page(f"/b_{book_id}", user_id=user_id)
+        name = book_names[book_id] = book_page.name
+    return name
+
+async def upload_book(call: CallbackQuery, book_id: int, book_format: str, book_file: InputFile):
+    sent = await bot.send_document(call.message.chat.id, book_file)
+    logger.info(f"User {call.from_user.username} {call.from_user.id} got his /b/{book_id}/{book_format} book")
+    book_sends.inc(source="file_cache" if isinstance(book_file, FSInputFile) else "download")
+    try:
+        await save_file_id(book_id, book_format, sent.document.file_id, sent.document.file_size)
+    except (SQLAlchemyError, OSError):
+        # the user has the book, the next click downloads it again
+        logger.exception(f"Can't save the file_id of /b/{book_id}/{book_format}")
+
+async def send_book(call: CallbackQuery, book_id: int, book_format: str):
+    if await send_cached_book(call, book_id, book_format):
+        return
+    size = prefetcher.format_size(book_id, book_format)
+    if size is not None and size >= TELEGRAM_LIMIT_BYTES:
+        # known from the HEAD check, no need to start the download
+        await call.answer()
+        await bot.send_message(chat_id=call.message.chat.id, text=BOOK_TOO_BIG_TEXT)
+        logger.info(f"User {call.from_user.username} {call.from_user.id} has requested too big book (format check)")
+        return
+    full_name = f"{await get_book_name(book_id, call.from_user.id)}.{book_format}"
+    path = await file_cache.get(book_id, book_format)
+    if path is not None:
+        # a local copy goes out right away, without the "loading" edits of the message
+        await call.answer()
+        await upload_book(call, book_id, book_format, FSInputFile(path, filename=full_name))
+        return
+    full_url = f"{Flibusta.url}/b/{book_id}/{book_format}"
     msg = call.message
-    name = msg.html_text.split('\n\n')[0]
-    full_name = f"{name}.{call.data.split('/')[-1]}"
-    file_b_coro = Flibusta.async_fetch(full_url)
     logger.info(f"User {call.from_user.username} with id {call.from_user.id} is downloading {full_name} from {full_url}")
     old_text = await message_or_caption_editor(msg, f"Загружается: {full_name}")
     await call.answer()
-    #todo handle it
     try:
-        file_as_bytes = await file_b_coro
-    #todo im not sure that it is exact exception
-    except ClientError:
+        async with Flibusta.async_download(full_url, TELEGRAM_LIMIT_BYTES, user_id=call.from_user.id) as downloaded:
+            await upload_book(call, book_id, book_format, DownloadInputFile(downloaded, filename=full_name))
+            await file_cache.put(book_id, book_format, downloaded)
+    except UpstreamError as error:
+        await bot.send_message(chat_id=msg.chat.id, text=UPSTREAM_ERROR_TEXT)
+        logger.warning(f"User {call.from_user.username} {call.from_user.id} didn't get {full_url}: {error}")
+    except FileTooBigException:
+        # if flibusta lies
         await bot.send_message(
             chat_id=msg.chat.id,
-            text='Проблема с подключением к флибусте, попробуйте немного позже',
+            text=BOOK_TOO_BIG_TEXT,
         )
-    else:
-        if len(file_as_bytes) >= TELEGRAM_LIMIT_BYTES:
-            # if flibusta lies
-            await bot.send_message(
-                chat_id=msg.chat.id,
-                text=f'Книга слишком большая (больше {TELEGRAM_LIMIT_MB} МБ) и его невозможно передать через Telegram API. Попробуйте найти другую версию книги.',
-            )
-            logger.info(f"User {call.from_user.username} {call.from_user.id} has requested too big book (download_handler)")
-        else:
-            await bot.send_document(msg.chat.id, BufferedInputFile(file_as_bytes, filename=full_name))
-            logger.info(f"User {call.from_user.username} {call.from_user.id} got his {full_url} book")
+        logger.info(f"User {call.from_user.username} {call.from_user.id} has requested too big book (download_handler)")
     finally:
         await message_or_caption_editor(msg, old_text, msg.reply_markup)
 
-async def gc_handler():
-    logger.info(f"Garbage collector started")
-    while True:
-        await asyncio.sleep(3600)
-        gc.collect()
-        logger.info("Garbage collector has worked")
+@dp.callback_query(DownloadCallback.filter())
+async def download_book_handler(call: CallbackQuery, callback_data: DownloadCallback):
+    await send_book(call, callback_data.book_id, callback_data.book_format.name)
 
-async def main() -> None:
-    loop = asyncio.get_event_loop()
-    loop.create_task(gc_handler())
+@dp.callback_query(lambda call: call.data.startswith("/b/"))
+async def download_link_handler(call: CallbackQuery):
+    # call.data looks like /b/12345/fb2: buttons sent before the compact callbacks, and unknown formats
+    _, _, book_id, book_format = call.data.split('/')
+    await send_book(call, int(book_id), book_format)
+
+@dp.errors(ExceptionTypeFilter(UpstreamError))
+async def upstream_error_handler(event: ErrorEvent):
+    # pages and searches that flibusta didn't answer on any mirror
+    update = event.update
+    if update.message is not None:
+        await update.message.answer(UPSTREAM_ERROR_TEXT)
+    elif update.callback_query is not None:
+        await update.callback_query.answer(UPSTREAM_ERROR_TEXT, show_alert=True)
+    logger.warning(f"Flibusta is unavailable: {event.exception}")
+
+async def prepare_database():
     table_exists = await init_db()
     if table_exists:
         logger.info("Database table already exists")
     else:
         logger.info("Database table was created")
-    await dp.start_polling(bot, loop=loop)
+
+async def catalogue_handler():
+    # the first refresh is due right away when the index is missing or older than the interval
+    refreshed_at = await asyncio.to_thread(Flibusta.catalogue.refreshed_at) or 0
+    delay = max(0.0, refreshed_at + CATALOGUE_REFRESH_INTERVAL - time.time())
+    while True:
+        await asyncio.sleep(delay)
+        delay = CATALOGUE_REFRESH_INTERVAL
+        try:
+            if await Flibusta.refresh_catalogue():
+                logger.info("Catalogue has been refreshed")
+            else:
+                logger.info("Catalogue dumps have not changed")
+        except Exception:
+            logger.exception("Catalogue refresh failed")
+
+async def warm_up_handler():
+    try:
+        book_ids = await get_popular_books(WARMUP_BOOKS, WARMUP_DAYS)
+    except Exception:
+        logger.exception("Can't load popular books for the warm-up")
+        return
+    logger.info(f"Warming up the page cache with {len(book_ids)} popular books")
+    prefetcher.warm_up(f"/b_{book_id}" for book_id in book_ids)
+
+async def start_services(metrics_port: int = METRICS_PORT, primary: bool = True) -> Optional[web.AppRunner]:
+    """primary is false for the webhook workers except the first, they skip the shared jobs."""
+    profiler.start()
+    await Flibusta.start_session()
+    middleware.start()
+    file_uses.start()
+    loop = asyncio.get_running_loop()
+    if primary and Flibusta.catalogue.enabled:
+        background_tasks.add(loop.create_task(catalogue_handler()))
+    # with a shared page cache one worker warms it up for all
+    if WARMUP_BOOKS > 0 and (primary or shared_storage is None):
+        background_tasks.add(loop.create_task(warm_up_handler()))
+    return await start_metrics_server(METRICS_HOST, metrics_port)
+
+async def stop_services(metrics_runner: Optional[web.AppRunner]):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await prefetcher.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await middleware.stop()
+    await file_uses.stop()
+    await Flibusta.close_session()
+    Flibusta.parser.shutdown()
+    await profiler.stop()
+    if shared_storage is not None:
+        await shared_storage.close()
+
+async def main() -> None:
+    loop = asyncio.get_event_loop()
+    await prepare_database()
+    # getUpdates doesn't work while a webhook is set
+    await bot.delete_webhook()
+    metrics_runner = await start_services()
+    try:
+        await dp.start_polling(bot, loop=loop)
+    finally:
+        await stop_services(metrics_runner)
+
+async def prepare_webhook():
+    """Runs once in the master process, before the workers start."""
+    await prepare_database()
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info(f"Webhook is set to {WEBHOOK_URL}{WEBHOOK_PATH}")
+    # the workers open their own connections
+    await bot.session.close()
+    await engine.dispose()
+
+def run_webhook_worker(worker: int):
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    # closes the bot session on shutdown
+    setup_application(app, dp, bot=bot)
+
+    async def on_startup(app: web.Application):
+        # every worker serves its own /metrics on the next port
+        # only the first worker writes the catalogue, the others read it
+        app["metrics_runner"] = await start_services(METRICS_PORT + worker if METRICS_PORT else 0, primary=worker == 0)
+
+    async def on_cleanup(app: web.Application):
+        await stop_services(app["metrics_runner"])
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    logger.info(f"Webhook worker {worker} is listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=WEB_WORKERS > 1, print=None)
+
+def run_webhook():
+    asyncio.run(prepare_webhook())
+    if WEB_WORKERS <= 1:
+        run_webhook_worker(0)
+        return
+    if shared_storage is None:
+        logger.warning("Workers don't share the page cache and seen users, set SHARED_STORAGE_URL")
+    # the kernel spreads connections between the workers listening on the same port
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_webhook_worker, args=(worker,), name=f"webhook-worker-{worker}")
+        for worker in range(WEB_WORKERS)
+    ]
+    for process in workers:
+        process.start()
+
+    def stop_workers(signum, frame):
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for process in workers:
+        process.join()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        asyncio.run(main())
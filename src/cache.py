@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Hashable, Iterator, Optional, Protocol
+
+from cachetools import TLRUCache
+
+from options import PAGE_CACHE_SIZE, PAGE_CACHE_MB, FILE_CACHE_DIR, FILE_CACHE_SIZE_MB
+from storage import BaseStorage, shared_storage
+
+logger = logging.getLogger("Bot logger.cache")
+
+
+def _time_to_use(key: Hashable, entry: tuple, now: float) -> float:
+    _, ttl = entry
+    return now + ttl
+
+
+def estimate_size(value: Any) -> int:
+    """Rough bytes held by a parsed page: its strings, numbers and containers."""
+    if value is None or isinstance(value, (str, bytes, int, float)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    # pages keep their data in slots, see ParseMixin._fields
+    fields = value._fields() if hasattr(value, "_fields") else getattr(value, "__dict__", {})
+    return sys.getsizeof(value) + sum(estimate_size(item) for item in fields.values())
+
+
+def _entry_size(entry: tuple) -> int:
+    value, _ = entry
+    return estimate_size(value)
+
+
+class PageCache:
+    """LRU cache of parsed pages where every entry carries its own ttl.
+
+    get/set work with the local cache only. load/store also go to the shared storage,
+    when there is one, so several bot workers parse every page once.
+    """
+
+    def __init__(
+            self,
+            size: int = PAGE_CACHE_SIZE,
+            max_bytes: int = PAGE_CACHE_MB * 1024 * 1024,
+            storage: Optional[BaseStorage] = shared_storage,
+    ):
+        # the cache itself is bounded by the estimated bytes, set() keeps the number of entries under size
+        self._data = TLRUCache(maxsize=max_bytes, ttu=_time_to_use, getsizeof=_entry_size)
+        self.size = size
+        self.storage = storage
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+
+    @staticmethod
+    def link_key(link: str) -> tuple:
+        return "page", link.strip()
+
+    @staticmethod
+    def search_key(query: str) -> tuple:
+        # "  Чехов  антон" and "чехов Антон" are the same search for flibusta
+        return "search", " ".join(query.split()).casefold()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        if ttl <= 0:
+            return
+        try:
+            self._data[key] = (value, ttl)
+        except ValueError:
+            # bigger than the whole cache, it is parsed again next time
+            logger.warning(f"Page {key} is too big for the page cache")
+            return
+        while len(self._data) > self.size:
+            self._data.popitem()
+
+    @property
+    def bytes(self) -> int:
+        return self._data.currsize
+
+    @staticmethod
+    def _storage_key(key: Hashable) -> str:
+        parts = key if isinstance(key, tuple) else (key,)
+        return "page:" + ":".join(str(part) for part in parts)
+
+    async def load(self, key: Hashable) -> Optional[Any]:
+        value = self.get(key)
+        if value is not None or self.storage is None:
+            return value
+        try:
+            entry = await self.storage.get(self._storage_key(key))
+        except Exception:
+            # the shared storage is an optimization, pages can always be fetched again
+            logger.exception("Shared page cache is unavailable")
+            return None
+        if entry is None:
+            return None
+        value, expires_at = entry
+        self.misses -= 1
+        self.hits += 1
+        self.shared_hits += 1
+        # live locally only as long as the other workers' copy
+        self.set(key, value, expires_at - time.time())
+        return value
+
+    async def store(self, key: Hashable, value: Any, ttl: float):
+        self.set(key, value, ttl)
+        if self.storage is None or ttl <= 0:
+            return
+        try:
+            await self.storage.set(self._storage_key(key), (value, time.time() + ttl), ttl)
+        except Exception:
+            logger.exception("Shared page cache is unavailable")
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        # doesn't count as a hit or a miss
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one running coroutine."""
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self.shared = 0
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # mark the exception as retrieved even if every caller has gone away
+            task.exception()
+
+    def join(self, key: Hashable, func: Callable[[], Awaitable]) -> asyncio.Task:
+        """The running call for key, started with func if there is none."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.shared += 1
+        return task
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Any:
+        # shield: one impatient caller must not cancel the request for the others
+        return await asyncio.shield(self.join(key, func))
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class ChunkedFile(Protocol):
+    size: int
+
+    def chunks(self) -> Iterator[bytes]: ...
+
+
+class FileCache:
+    """Size-bounded directory of downloaded books, least recently used files are removed first."""
+
+    def __init__(self, directory: str = FILE_CACHE_DIR, size_mb: int = FILE_CACHE_SIZE_MB):
+        self.directory = directory
+        self.max_bytes = size_mb * 1024 * 1024
+        # callers of one coalesced download share the write of its copy
+        self._writes = SingleFlight()
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.max_bytes > 0
+
+    def _path(self, book_id: int, book_format: str) -> str:
+        return os.path.join(self.directory, f"{book_id}.{book_format}")
+
+    def _touch(self, path: str) -> Optional[str]:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _write(self, path: str, file: ChunkedFile):
+        try:
+            if os.path.getsize(path) == file.size:
+                # written already by an earlier caller of the same download
+                os.utime(path)
+                return
+        except FileNotFoundError:
+            pass
+        # concurrent writers of the same book each get their own temp file, the last rename wins
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in file.chunks():
+                    out.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    async def get(self, book_id: int, book_format: str) -> Optional[str]:
+        """Path of the cached book or None."""
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self._touch, self._path(book_id, book_format))
+
+    async def put(self, book_id: int, book_format: str, file: ChunkedFile):
+        if not self.enabled or file.size > self.max_bytes:
+            return
+        path = self._path(book_id, book_format)
+        try:
+            await self._writes.do(path, lambda: asyncio.to_thread(self._write, path, file))
+        except OSError:
+            # the book has been sent already, a full disk only costs a later download
+            logger.exception(f"Can't cache {book_id}.{book_format}")
@@ -0,0 +1,328 @@
+"""Local search index of the flibusta catalogue, built from the SQL dumps the site publishes.
+
+    python catalogue.py index.sqlite lib.libbook.sql.gz lib.libavtorname.sql.gz lib.libavtor.sql.gz
+
+Titles and author names go to SQLite FTS5 tables. A refresh loads the new dumps into staging
+tables and writes only the books and authors that changed, triggers keep the full-text
+tables in sync. Searches run in a thread and never touch flibusta.
+"""
+import asyncio
+import gzip
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from typing import IO, Iterator, Optional
+
+from options import CATALOGUE_PATH, CATALOGUE_SEARCH_LIMIT
+
+logger = logging.getLogger("Bot logger.catalogue")
+
+# table in the dump -> file name on flibusta.is/sql/
+DUMPS = {
+    "libbook": "lib.libbook.sql.gz",
+    "libavtorname": "lib.libavtorname.sql.gz",
+    "libavtor": "lib.libavtor.sql.gz",
+}
+
+AUTHORS_HEADER = "Найденные писатели ({}):"
+BOOKS_HEADER = "Найденные книги ({}):"
+
+_TOKENIZER = "unicode61 remove_diacritics 2"
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT);
+
+CREATE TABLE IF NOT EXISTS books(id INTEGER PRIMARY KEY, title TEXT NOT NULL, authors TEXT NOT NULL);
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    title, authors, content='books', content_rowid='id', tokenize='{_TOKENIZER}'
+);
+CREATE TRIGGER IF NOT EXISTS books_ai AFTER INSERT ON books BEGIN
+    INSERT INTO books_fts(rowid, title, authors) VALUES (new.id, normalize(new.title), normalize(new.authors));
+END;
+CREATE TRIGGER IF NOT EXISTS books_ad AFTER DELETE ON books BEGIN
+    INSERT INTO books_fts(books_fts, rowid, title, authors)
+    VALUES ('delete', old.id, normalize(old.title), normalize(old.authors));
+END;
+CREATE TRIGGER IF NOT EXISTS books_au AFTER UPDATE ON books BEGIN
+    INSERT INTO books_fts(books_fts, rowid, title, authors)
+    VALUES ('delete', old.id, normalize(old.title), normalize(old.authors));
+    INSERT INTO books_fts(rowid, title, authors) VALUES (new.id, normalize(new.title), normalize(new.authors));
+END;
+
+CREATE TABLE IF NOT EXISTS authors(id INTEGER PRIMARY KEY, name TEXT NOT NULL, books INTEGER NOT NULL);
+CREATE VIRTUAL TABLE IF NOT EXISTS authors_fts USING fts5(
+    name, content='authors', content_rowid='id', tokenize='{_TOKENIZER}'
+);
+CREATE TRIGGER IF NOT EXISTS authors_ai AFTER INSERT ON authors BEGIN
+    INSERT INTO authors_fts(rowid, name) VALUES (new.id, normalize(new.name));
+END;
+CREATE TRIGGER IF NOT EXISTS authors_ad AFTER DELETE ON authors BEGIN
+    INSERT INTO authors_fts(authors_fts, rowid, name) VALUES ('delete', old.id, normalize(old.name));
+END;
+CREATE TRIGGER IF NOT EXISTS authors_au AFTER UPDATE ON authors WHEN old.name IS NOT new.name BEGIN
+    INSERT INTO authors_fts(authors_fts, rowid, name) VALUES ('delete', old.id, normalize(old.name));
+    INSERT INTO authors_fts(rowid, name) VALUES (new.id, normalize(new.name));
+END;
+"""
+
+_MERGE = """
+CREATE INDEX stage_links_book ON stage_links(book_id);
+
+CREATE TEMP TABLE new_books AS
+SELECT b.id, b.title, coalesce((
+    SELECT group_concat(name, ', ') FROM (
+        SELECT n.name FROM stage_links l JOIN stage_names n ON n.id = l.author_id
+        WHERE l.book_id = b.id ORDER BY l.pos
+    )
+), '') AS authors
+FROM stage_books b WHERE NOT b.deleted;
+
+CREATE TEMP TABLE new_authors AS
+SELECT n.id, n.name, count(*) AS books
+FROM stage_names n JOIN stage_links l ON l.author_id = n.id JOIN stage_books b ON b.id = l.book_id
+WHERE NOT b.deleted AND n.name != ''
+GROUP BY n.id;
+
+DELETE FROM books WHERE id NOT IN (SELECT id FROM new_books);
+INSERT INTO books(id, title, authors) SELECT id, title, authors FROM new_books WHERE true
+ON CONFLICT(id) DO UPDATE SET title = excluded.title, authors = excluded.authors
+WHERE books.title IS NOT excluded.title OR books.authors IS NOT excluded.authors;
+
+DELETE FROM authors WHERE id NOT IN (SELECT id FROM new_authors);
+INSERT INTO authors(id, name, books) SELECT id, name, books FROM new_authors WHERE true
+ON CONFLICT(id) DO UPDATE SET name = excluded.name, books = excluded.books
+WHERE authors.name IS NOT excluded.name OR authors.books IS NOT excluded.books;
+"""
+
+_create_table_pattern = re.compile(r"CREATE TABLE `(\w+)`")
+_column_pattern = re.compile(r"^\s+`(\w+)`")
+_insert_pattern = re.compile(r"INSERT INTO `(\w+)` VALUES ")
+_token_pattern = re.compile(r"'(?:[^'\\]|\\.)*'|[(),;]|[^,()';\s]+")
+_escape_pattern = re.compile(r"\\(.)", re.DOTALL)
+_escapes = {"0": "\0", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+_word_pattern = re.compile(r"\w+")
+
+
+def normalize(text: Optional[str]) -> str:
+    # unicode61 folds the case, but not ё
+    return (text or "").replace("ё", "е").replace("Ё", "Е")
+
+
+def _value(token: str):
+    if token.startswith("'"):
+        return _escape_pattern.sub(lambda match: _escapes.get(match.group(1), match.group(1)), token[1:-1])
+    if token == "NULL":
+        return None
+    try:
+        return int(token)
+    except ValueError:
+        return token
+
+
+def _open_dump(path: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def read_dump(path: str) -> Iterator[tuple[str, dict]]:
+    """(table, row as a dict) for every row of a mysqldump file, plain or gzipped."""
+    columns: dict[str, list[str]] = {}
+    table = None
+    with _open_dump(path) as dump:
+        for line in dump:
+            match = _create_table_pattern.match(line)
+            if match:
+                table = match.group(1)
+                columns[table] = []
+                continue
+            if table is not None:
+                match = _column_pattern.match(line)
+                if match:
+                    columns[table].append(match.group(1))
+                    continue
+                if line.startswith(")"):
+                    table = None
+                continue
+            match = _insert_pattern.match(line)
+            if not match:
+                continue
+            names = columns[match.group(1)]
+            row = []
+            for token in _token_pattern.findall(line, match.end()):
+                if token == "(":
+                    row = []
+                elif token == ")":
+                    yield match.group(1), dict(zip(names, row))
+                elif token not in ",;":
+                    row.append(_value(token))
+
+
+def _author_name(row: dict) -> str:
+    # flibusta shows authors as "Last First Middle"
+    parts = (row.get("LastName"), row.get("FirstName"), row.get("MiddleName"))
+    name = " ".join(" ".join(part for part in parts if part).split())
+    return name or " ".join((row.get("NickName") or "").split())
+
+
+def connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path)
+    connection.create_function("normalize", 1, normalize, deterministic=True)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def build_index(path: str, dumps: dict[str, str], meta: Optional[dict[str, str]] = None) -> tuple[int, int]:
+    """Merges the dumps into the index at path, returns the number of books and authors in it.
+
+    Runs in a separate process during a refresh, parsing the dumps takes a while.
+    meta is saved with the index, the refresh keeps Last-Modified of every dump there.
+    """
+    connection = connect(path)
+    try:
+        connection.executescript("""
+            CREATE TEMP TABLE stage_books(id INTEGER PRIMARY KEY, title TEXT, deleted INTEGER);
+            CREATE TEMP TABLE stage_names(id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TEMP TABLE stage_links(book_id INTEGER, author_id INTEGER, pos INTEGER);
+        """)
+        for table, dump in dumps.items():
+            rows = (row for row_table, row in read_dump(dump) if row_table == table)
+            if table == "libbook":
+                connection.executemany(
+                    "INSERT OR REPLACE INTO stage_books VALUES (?, ?, ?)",
+                    ((row["BookId"], row["Title"] or "", str(row["Deleted"]) not in ("0", "")) for row in rows),
+                )
+            elif table == "libavtorname":
+                connection.executemany(
+                    "INSERT OR REPLACE INTO stage_names VALUES (?, ?)",
+                    ((row["AvtorId"], _author_name(row)) for row in rows),
+                )
+            elif table == "libavtor":
+                connection.executemany(
+                    "INSERT INTO stage_links VALUES (?, ?, ?)",
+                    ((row["BookId"], row["AvtorId"], row.get("Pos") or 0) for row in rows),
+                )
+        with connection:
+            before = connection.total_changes
+            connection.executescript("BEGIN;" + _MERGE)
+            meta = {**(meta or {}), "refreshed_at": str(int(time.time()))}
+            connection.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items())
+        changed = connection.total_changes - before
+        books, authors = connection.execute(
+            "SELECT (SELECT count(*) FROM books), (SELECT count(*) FROM authors)").fetchone()
+        logger.info(f"Catalogue has {books} books and {authors} authors, {changed} rows changed")
+        return books, authors
+    finally:
+        connection.close()
+
+
+class Catalogue:
+    """Answers searches from the local index, None means flibusta has to be asked."""
+
+    def __init__(self, path: str = CATALOGUE_PATH, limit: int = CATALOGUE_SEARCH_LIMIT):
+        self.path = path
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._ready = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _connection(self) -> sqlite3.Connection:
+        # one read-only connection per thread of the default executor
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self._local.connection = connection
+        return connection
+
+    def meta(self, key: str) -> Optional[str]:
+        if not self.enabled or not os.path.exists(self.path):
+            return None
+        try:
+            row = self._connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return None if row is None else row[0]
+
+    def is_ready(self) -> bool:
+        if not self._ready:
+            self._ready = self.meta("refreshed_at") is not None
+        return self._ready
+
+    def refreshed_at(self) -> Optional[float]:
+        refreshed_at = self.meta("refreshed_at")
+        return None if refreshed_at is None else float(refreshed_at)
+
+    @staticmethod
+    def _match(words: list[str]) -> str:
+        return " ".join(f'"{word}"*' for word in words)
+
+    @staticmethod
+    def _relaxed(words: list[str]) -> list[str]:
+        # cut the endings: "вишнёвого сада" finds "Вишнёвый сад", a typo near the end is forgiven too
+        return [word[:max(3, len(word) - max(1, len(word) // 3))] if len(word) > 3 else word for word in words]
+
+    def _find(self, match: str) -> tuple[list, list]:
+        connection = self._connection()
+        authors = connection.execute(
+            "SELECT a.id, a.name FROM authors_fts JOIN authors a ON a.id = authors_fts.rowid "
+            "WHERE authors_fts MATCH ? ORDER BY a.books DESC, bm25(authors_fts) LIMIT ?",
+            (match, self.limit),
+        ).fetchall()
+        books = connection.execute(
+            "SELECT b.id, b.title FROM books_fts JOIN books b ON b.id = books_fts.rowid "
+            "WHERE books_fts MATCH ? ORDER BY bm25(books_fts, 10.0, 1.0) LIMIT ?",
+            (match, self.limit),
+        ).fetchall()
+        return authors, books
+
+    def search_sync(self, query: str) -> Optional[dict[str, list[str]]]:
+        if not self.is_ready():
+            return None
+        words = _word_pattern.findall(normalize(query).casefold())
+        if not words:
+            return None
+        authors, books = self._find(self._match(words))
+        if not authors and not books:
+            relaxed = self._relaxed(words)
+            if relaxed != words:
+                authors, books = self._find(self._match(relaxed))
+        if not authors and not books:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # the same lines SearchPage makes of the flibusta search page
+        result = {}
+        if authors:
+            result[AUTHORS_HEADER.format(len(authors))] = [f"{name} /a_{num}" for num, name in authors]
+        if books:
+            result[BOOKS_HEADER.format(len(books))] = [f"{title} /b_{num}" for num, title in books]
+        return result
+
+    async def search(self, query: str) -> Optional[dict[str, list[str]]]:
+        if not self.enabled:
+            return None
+        try:
+            return await asyncio.to_thread(self.search_sync, query)
+        except sqlite3.Error:
+            logger.exception("Catalogue search failed")
+            return None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    index_path, dump_paths = sys.argv[1], sys.argv[2:]
+    # dumps are recognized by their file names
+    build_index(index_path, {
+        table: next(path for path in dump_paths if os.path.basename(path).startswith(name.split(".sql")[0]))
+        for table, name in DUMPS.items()
+    })
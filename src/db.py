@@ -1,16 +1,72 @@
-from typing import Callable
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from collections import Counter
+from typing import Callable, Optional
 
 from aiogram import BaseMiddleware
 from aiogram.types import Update, TelegramObject
-from cachetools import LRUCache
-from sqlalchemy import Column, Integer, String, DateTime, func
-from sqlalchemy import select, inspect
+from cachetools import TTLCache
+from sqlalchemy import Column, Integer, String, DateTime, UniqueConstraint, func
+from sqlalchemy import bindparam, inspect, select, update, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from options import DATABASE_URL
+from options import DATABASE_URL, USER_CACHE_SIZE, USER_CACHE_TTL, USER_FLUSH_SIZE, USER_FLUSH_INTERVAL
+from options import FILE_USES_FLUSH_INTERVAL
+from options import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING
+from storage import BaseStorage, shared_storage
 
-engine = create_async_engine(DATABASE_URL)
+# bump it when tables are added, so init_db runs create_all again
+SCHEMA_VERSION = 2
+
+logger = logging.getLogger("Bot logger.db")
+
+class PoolStats:
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.overflows = 0
+        self.timeouts = 0
+
+pool_stats = PoolStats()
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records checkout wait time, overflow connections and timeouts in pool_stats."""
+
+    def _do_get(self):
+        overflow = self.overflow()
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.timeouts += 1
+            logger.warning(f"Database pool is exhausted: {self.status()}")
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            pool_stats.wait_seconds += wait
+            pool_stats.max_wait_seconds = max(pool_stats.max_wait_seconds, wait)
+        pool_stats.checkouts += 1
+        if self.overflow() > max(overflow, 0):
+            pool_stats.overflows += 1
+        return connection
+
+engine = create_async_engine(
+    DATABASE_URL,
+    poolclass=InstrumentedPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
 Base = declarative_base()
 Session = async_sessionmaker(bind=engine)
 
@@ -24,40 +80,267 @@ class User(Base):
     language_code = Column(String(255))
     registered_on = Column(DateTime, nullable=False, default=func.now())
 
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    __table_args__ = {'schema': 'public'}
+    version = Column(Integer, primary_key=True)
+
+class BookFile(Base):
+    # telegram file_id of a book already uploaded once, reused instead of downloading it again
+    __tablename__ = 'book_files'
+    __table_args__ = (
+        UniqueConstraint('book_id', 'book_format'),
+        {'schema': 'public'},
+    )
+    pk = Column(Integer, primary_key=True, autoincrement=True)
+    book_id = Column(Integer, nullable=False)
+    book_format = Column(String(32), nullable=False)
+    file_id = Column(String(255), nullable=False)
+    file_size = Column(Integer)
+    uses = Column(Integer, nullable=False, default=0)
+    created_on = Column(DateTime, nullable=False, default=func.now())
+    last_used = Column(DateTime, nullable=False, default=func.now())
+
 class UserMiddleware(BaseMiddleware):
+    """Registers users in the background, handlers never wait for the database.
 
-    def __init__(self, size=1000):
-        self.user_cache = LRUCache(maxsize=size)
-
-    async def get_or_create_user(self, event: TelegramObject, session: Session) -> User:
-        result = await session.execute(select(User).filter_by(user_id=event.from_user.id))
-        user = result.scalar_one_or_none()
-        if user is None:
-            user = User(
-                user_id=event.from_user.id,
-                username=event.from_user.username,
-                name=event.from_user.full_name,
-                language_code=event.from_user.language_code,
-            )
-            session.add(user)
-            await session.commit()
-        self.user_cache[event.from_user.id] = user
-        return user
+    Users missing from the presence cache are queued and upserted in batches, when the queue
+    reaches flush_size or every flush_interval seconds. The cache has a ttl, so changed
+    usernames and names get written again once in a while. With a shared storage the
+    workers agree on who saves a user, so a user talking to several workers is written once.
+    """
 
-    async def __call__(self, handler: Callable, update: Update, data):
-        event = update.event
-        user = self.user_cache.get(event.from_user.id)
-        if user is None:
+    def __init__(
+            self,
+            size: int = USER_CACHE_SIZE,
+            ttl: int = USER_CACHE_TTL,
+            flush_size: int = USER_FLUSH_SIZE,
+            flush_interval: float = USER_FLUSH_INTERVAL,
+            storage: Optional[BaseStorage] = shared_storage,
+    ):
+        self.user_cache = TTLCache(maxsize=size, ttl=ttl)
+        self.ttl = ttl
+        self.storage = storage
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue: dict[int, dict] = {}
+        self._flush_requested = asyncio.Event()
+        self._stopping = False
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def track_user(self, event: TelegramObject):
+        from_user = getattr(event, 'from_user', None)
+        if from_user is None or from_user.id in self.user_cache:
+            return
+        self.user_cache[from_user.id] = True
+        self.queue[from_user.id] = dict(
+            user_id=from_user.id,
+            username=from_user.username,
+            name=from_user.full_name,
+            language_code=from_user.language_code,
+        )
+        if len(self.queue) >= self.flush_size:
+            self._flush_requested.set()
+
+    async def _claim(self, batch: dict[int, dict]) -> dict[int, dict]:
+        """Users of the batch that no other worker has saved recently."""
+        if self.storage is None:
+            return batch
+        try:
+            claimed = await asyncio.gather(*(self.storage.add(f"user:{user_id}", self.ttl) for user_id in batch))
+        except Exception:
+            logger.exception("Shared storage is unavailable, saving all queued users")
+            return batch
+        return {user_id: user for (user_id, user), new in zip(batch.items(), claimed) if new}
+
+    async def _unclaim(self, batch: dict[int, dict]):
+        if self.storage is None:
+            return
+        try:
+            await self.storage.delete(*(f"user:{user_id}" for user_id in batch))
+        except Exception:
+            logger.exception("Shared storage is unavailable")
+
+    async def flush(self):
+        if not self.queue:
+            return
+        batch, self.queue = self.queue, {}
+        batch = await self._claim(batch)
+        if not batch:
+            return
+        statement = insert(User).values(list(batch.values()))
+        statement = statement.on_conflict_do_update(
+            index_elements=[User.user_id],
+            set_={'username': statement.excluded.username, 'name': statement.excluded.name},
+        )
+        try:
             async with Session() as session:
-                await self.get_or_create_user(event, session)
+                await session.execute(statement)
+                await session.commit()
+        except Exception:
+            logger.exception(f"Failed to save {len(batch)} users, will retry")
+            await self._unclaim(batch)
+            # users queued meanwhile are newer than the failed batch
+            self.queue = batch | self.queue
+        else:
+            logger.debug(f"Saved {len(batch)} users")
+
+    async def _flush_loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._stopping = False
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            # not cancelled: a batch taken from the queue would be lost in the middle of its write
+            self._stopping = True
+            self._flush_requested.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+
+    async def __call__(self, handler: Callable, update: Update, data):
+        self.track_user(update.event)
         return await handler(update, data)
 
+class FileUses:
+    """Counts sends of cached telegram files and writes them in one batch every flush_interval seconds.
+
+    The lookup on a download click stays a plain select, uses and last_used only feed the warm-up.
+    """
+
+    def __init__(self, flush_interval: float = FILE_USES_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.queue: Counter[tuple[int, str]] = Counter()
+        self._stop_requested = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def record(self, book_id: int, book_format: str):
+        self.queue[(book_id, book_format)] += 1
+
+    async def flush(self):
+        if not self.queue:
+            return
+        batch, self.queue = self.queue, Counter()
+        table = BookFile.__table__
+        statement = (
+            update(table)
+            .where(table.c.book_id == bindparam('b_book_id'), table.c.book_format == bindparam('b_book_format'))
+            .values(uses=table.c.uses + bindparam('b_uses'), last_used=func.now())
+        )
+        # the same order in every worker, so concurrent flushes don't deadlock on the rows
+        params = [
+            dict(b_book_id=book_id, b_book_format=book_format, b_uses=uses)
+            for (book_id, book_format), uses in sorted(batch.items())
+        ]
+        try:
+            async with Session() as session:
+                await session.execute(statement, params)
+                await session.commit()
+        except Exception:
+            logger.exception(f"Failed to save uses of {len(batch)} files, will retry")
+            self.queue.update(batch)
+
+    async def _flush_loop(self):
+        while not self._stop_requested.is_set():
+            try:
+                await asyncio.wait_for(self._stop_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._stop_requested.clear()
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            # like UserMiddleware, a running flush is awaited, not cancelled with its batch
+            self._stop_requested.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+
+file_uses = FileUses()
+
+async def get_file_id(book_id: int, book_format: str) -> Optional[str]:
+    async with Session() as session:
+        result = await session.execute(
+            select(BookFile.file_id).filter_by(book_id=book_id, book_format=book_format)
+        )
+        return result.scalar_one_or_none()
+
+async def save_file_id(book_id: int, book_format: str, file_id: str, file_size: int):
+    statement = insert(BookFile).values(
+        book_id=book_id,
+        book_format=book_format,
+        file_id=file_id,
+        file_size=file_size,
+        uses=1,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[BookFile.book_id, BookFile.book_format],
+        set_={'file_id': statement.excluded.file_id, 'file_size': statement.excluded.file_size},
+    )
+    async with Session() as session:
+        await session.execute(statement)
+        await session.commit()
+
+async def forget_file_id(book_id: int, book_format: str):
+    async with Session() as session:
+        await session.execute(delete(BookFile).filter_by(book_id=book_id, book_format=book_format))
+        await session.commit()
+
+async def get_popular_books(limit: int, days: int) -> list[int]:
+    """Books sent most often among those used in the last days, for the cache warm-up."""
+    async with Session() as session:
+        result = await session.execute(
+            select(BookFile.book_id)
+            .where(BookFile.last_used >= func.now() - timedelta(days=days))
+            .group_by(BookFile.book_id)
+            .order_by(func.sum(BookFile.uses).desc())
+            .limit(limit)
+        )
+        return list(result.scalars())
+
+def pool_status() -> dict:
+    pool = engine.pool
+    return dict(
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        overflow=max(pool.overflow(), 0),
+        checkouts=pool_stats.checkouts,
+        wait_seconds=pool_stats.wait_seconds,
+        max_wait_seconds=pool_stats.max_wait_seconds,
+        overflows=pool_stats.overflows,
+        timeouts=pool_stats.timeouts,
+    )
+
 async def init_db() -> bool:
     async with engine.begin() as conn:
+        try:
+            async with conn.begin_nested():
+                version = (await conn.execute(select(func.max(SchemaVersion.version)))).scalar()
+        except DBAPIError:
+            # database older than schema_version table
+            version = None
+        if version == SCHEMA_VERSION:
+            # one query instead of reflecting the schema on every start
+            return True
         inspector = await conn.run_sync(lambda sync_conn: inspect(sync_conn))
         exists = await conn.run_sync(
             lambda sync_conn: inspector.has_table('users')
         )
-        if not exists:
-            await conn.run_sync(Base.metadata.create_all)
+        # create_all skips existing tables, so tables added later appear on old databases too
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(SchemaVersion).values(version=SCHEMA_VERSION).on_conflict_do_nothing())
     return exists
@@ -0,0 +1,17 @@
+-- MySQL dump 10.13  Distrib 5.5.62, for debian-linux-gnu (x86_64)
+--
+-- Host: localhost    Database: flibusta
+-- ------------------------------------------------------
+
+DROP TABLE IF EXISTS `libavtor`;
+CREATE TABLE `libavtor` (
+  `BookId` int(10) unsigned NOT NULL DEFAULT '0',
+  `AvtorId` int(10) unsigned NOT NULL DEFAULT '0',
+  `Pos` tinyint(4) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`BookId`,`AvtorId`),
+  KEY `iav` (`AvtorId`)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+
+LOCK TABLES `libavtor` WRITE;
+INSERT INTO `libavtor` VALUES (10501,10463,0),(10502,10463,0),(10503,10463,0),(10504,48813,0),(531326,18862,0),(807198,48812,0),(10503,30121,1);
+UNLOCK TABLES;
@@ -0,0 +1,22 @@
+-- MySQL dump 10.13  Distrib 5.5.62, for debian-linux-gnu (x86_64)
+--
+-- Host: localhost    Database: flibusta
+-- ------------------------------------------------------
+
+DROP TABLE IF EXISTS `libavtorname`;
+CREATE TABLE `libavtorname` (
+  `AvtorId` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `FirstName` varchar(99) CHARACTER SET utf8 NOT NULL DEFAULT '',
+  `MiddleName` varchar(99) CHARACTER SET utf8 NOT NULL DEFAULT '',
+  `LastName` varchar(99) CHARACTER SET utf8 NOT NULL DEFAULT '',
+  `NickName` varchar(33) CHARACTER SET utf8 NOT NULL DEFAULT '',
+  `Email` varchar(85) CHARACTER SET utf8 NOT NULL,
+  `Gender` char(1) CHARACTER SET utf8 NOT NULL DEFAULT '',
+  `MasterId` int(10) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`AvtorId`),
+  KEY `LastName` (`LastName`(10))
+) ENGINE=MyISAM AUTO_INCREMENT=48813 DEFAULT CHARSET=utf8;
+
+LOCK TABLES `libavtorname` WRITE;
+INSERT INTO `libavtorname` VALUES (10463,'Антон','Павлович','Чехов','','','m',0),(18862,'Жюль','','Верн','','','m',0),(30121,'Михаил','Павлович','Чехов','','','m',0),(48812,'','','','Anonymous','','',0),(48813,'Пётр','','Нечитаемый','','','m',0);
+UNLOCK TABLES;
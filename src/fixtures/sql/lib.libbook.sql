@@ -0,0 +1,25 @@
+-- MySQL dump 10.13  Distrib 5.5.62, for debian-linux-gnu (x86_64)
+--
+-- Host: localhost    Database: flibusta
+-- ------------------------------------------------------
+
+DROP TABLE IF EXISTS `libbook`;
+CREATE TABLE `libbook` (
+  `BookId` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `FileSize` int(10) unsigned NOT NULL DEFAULT '0',
+  `Time` datetime NOT NULL,
+  `Title` varchar(254) CHARACTER SET utf8 NOT NULL DEFAULT '',
+  `Title1` varchar(254) CHARACTER SET utf8 NOT NULL,
+  `Lang` char(3) CHARACTER SET utf8 NOT NULL DEFAULT 'ru',
+  `FileType` char(4) CHARACTER SET utf8 NOT NULL,
+  `Year` smallint(6) NOT NULL DEFAULT '0',
+  `Deleted` char(1) CHARACTER SET utf8 NOT NULL DEFAULT '0',
+  `md5` char(32) CHARACTER SET utf8 NOT NULL,
+  PRIMARY KEY (`BookId`),
+  KEY `Title` (`Title`)
+) ENGINE=MyISAM AUTO_INCREMENT=807199 DEFAULT CHARSET=utf8;
+
+LOCK TABLES `libbook` WRITE;
+INSERT INTO `libbook` VALUES (10501,2097152,'2005-01-01 00:00:00','Вишнёвый сад','','ru','fb2',1904,'0','d41d8cd98f00b204e9800998ecf8427e'),(10502,51200,'2005-01-01 00:00:00','Палата № 6','','ru','fb2',1892,'0','d41d8cd98f00b204e9800998ecf8427f'),(10503,40960,'2005-01-01 00:00:00','Дама с собачкой','','ru','fb2',1899,'0','d41d8cd98f00b204e9800998ecf84280'),(10504,40960,'2005-01-01 00:00:00','Удалённая книга','','ru','fb2',1900,'1','d41d8cd98f00b204e9800998ecf84281');
+INSERT INTO `libbook` VALUES (531326,1626112,'2018-06-01 12:00:00','Вокруг света за 80 дней','','ru','fb2',1872,'0','d41d8cd98f00b204e9800998ecf84282'),(807198,30720,'2024-01-01 12:00:00','The \'Quoted\' Title, (part 1)','','en','epub',2020,'0','d41d8cd98f00b204e9800998ecf84283');
+UNLOCK TABLES;
@@ -1,33 +1,370 @@
+import asyncio
+import multiprocessing
+import os
+import random
 import re
-from typing import Union
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from itertools import islice
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from enum import IntEnum
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Iterator, Optional, Union
 from urllib import parse
 
 import fake_useragent
-from aiohttp import ClientSession
+import lxml.html
+from aiohttp import ClientError, ClientResponse, ClientSession, ClientTimeout, TCPConnector
 from aiohttp_socks import ProxyConnector
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from lxml.etree import ParserError
 
-from options import PROXY
+from cache import PageCache, SingleFlight
+from catalogue import Catalogue, DUMPS, build_index
+from metrics import fetch_seconds, upstream_errors, upstream_retries, hedged_requests, parse_seconds, download_bytes
+from mirrors import Mirror, MirrorPool
+from scheduler import Priority, SlotUnavailable, UpstreamScheduler
+from options import FLIBUSTA_URL, FLIBUSTA_MIRRORS, PROXY, HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_KEEPALIVE_TIMEOUT, HTTP_DNS_CACHE_TTL
+from options import CACHE_BOOK_TTL, CACHE_AUTHOR_TTL, CACHE_SEARCH_TTL, CACHE_NEGATIVE_TTL
+from options import DOWNLOAD_CHUNK_SIZE, DOWNLOAD_SPOOL_BYTES, PARSER_BACKEND, PARSE_EXECUTOR, PARSE_WORKERS
+from options import RESULTS_PAGE_SIZE
+from options import UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_PAGE_TIMEOUT, UPSTREAM_READ_TIMEOUT
+from options import UPSTREAM_RETRIES, UPSTREAM_BACKOFF, UPSTREAM_HEDGE_DELAY
+
+# send(session, url, timeout), one attempt of a request to one mirror
+Send = Callable[[ClientSession, str, ClientTimeout], Awaitable]
+# operations timed per chunk instead of as a whole
+STREAMED_OPERATIONS = ("download", "dump")
+
+
+class DownloadedFile:
+    """Downloaded book spooled in memory, or on disk when it gets big.
+
+    One file can be shared by several readers (coalesced downloads, the file cache thread),
+    so every reader keeps its own offset instead of using the file position.
+    """
+
+    def __init__(self, spool_size: int = DOWNLOAD_SPOOL_BYTES):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self._lock = threading.Lock()
+        self.spool_size = spool_size
+        self.size = 0
+
+    def spills(self, chunk: bytes) -> bool:
+        """True when writing chunk goes to the disk, the first such write also moves the spool there."""
+        return self.size + len(chunk) > self.spool_size
+
+    def write(self, chunk: bytes):
+        with self._lock:
+            self._file.seek(self.size)
+            self._file.write(chunk)
+            self.size += len(chunk)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def chunks(self, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+        offset = 0
+        while chunk := self.read_at(offset, chunk_size):
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
 
 
 class BaseRequest:
 
-    url = "http://flibusta.is"
+    url = FLIBUSTA_URL
+    # None connects directly, tests use it with the local mock server
+    proxy: Optional[str] = PROXY
     headers = {
         "User-Agent": fake_useragent.FakeUserAgent().firefox
     }
+    session: Optional[ClientSession] = None
+    inflight = SingleFlight()
+    # callers of every running or finished download that haven't left its block yet
+    _download_users: Counter = Counter()
+    scheduler = UpstreamScheduler()
+    # url is always one of the mirrors, the others come from FLIBUSTA_MIRRORS
+    mirrors = MirrorPool(FLIBUSTA_MIRRORS)
+    retries = UPSTREAM_RETRIES
+    backoff = UPSTREAM_BACKOFF
+    hedge_delay = UPSTREAM_HEDGE_DELAY
+
+    @classmethod
+    def _create_connector(cls) -> TCPConnector:
+        pool_options = dict(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        if cls.proxy is None:
+            return TCPConnector(**pool_options)
+        return ProxyConnector.from_url(cls.proxy, rdns=True, **pool_options)
+
+    @classmethod
+    async def start_session(cls) -> ClientSession:
+        # one pooled session for the whole bot: keep-alive saves a socks handshake per request
+        if cls.session is None or cls.session.closed:
+            cls.session = ClientSession(headers=cls.headers, connector=cls._create_connector())
+        return cls.session
+
+    @classmethod
+    async def close_session(cls):
+        if cls.session is not None and not cls.session.closed:
+            await cls.session.close()
+        cls.session = None
+
+    @staticmethod
+    @contextmanager
+    def _measure(operation: str):
+        # only the time on the wire, waiting for a scheduler slot is not counted
+        start = time.perf_counter()
+        try:
+            yield
+        except (ClientError, asyncio.TimeoutError) as error:
+            upstream_errors.inc(operation=operation, error=type(error).__name__)
+            raise
+        finally:
+            fetch_seconds.observe(time.perf_counter() - start, operation=operation)
+
+    @staticmethod
+    def _timeout(operation: str) -> ClientTimeout:
+        if operation in STREAMED_OPERATIONS:
+            # a big book takes long on a slow proxy, only a stalled transfer is given up
+            return ClientTimeout(total=None, sock_connect=UPSTREAM_CONNECT_TIMEOUT, sock_read=UPSTREAM_READ_TIMEOUT)
+        return ClientTimeout(total=UPSTREAM_PAGE_TIMEOUT, sock_connect=UPSTREAM_CONNECT_TIMEOUT)
+
+    @staticmethod
+    def _check_status(response: ClientResponse):
+        # an overloaded or broken mirror, the next one may answer
+        if response.status >= 500 or response.status == 429:
+            response.raise_for_status()
+
+    @classmethod
+    async def _attempt(
+            cls, url: str, mirror: Mirror, operation: str, send: Send,
+            user_id: Optional[Hashable], priority: Priority,
+    ):
+        session = await cls.start_session()
+        async with cls.scheduler.slot(user_id, priority):
+            with cls._measure(operation), cls.mirrors.track(mirror, latency=operation not in STREAMED_OPERATIONS):
+                return await send(session, cls.mirrors.rewrite(url, cls.url, mirror), cls._timeout(operation))
+
+    @staticmethod
+    async def _hedge(first: Callable[[], Awaitable], second: Callable[[], Awaitable], delay: float):
+        """Result of first, or of second when first is slower than delay and second finishes earlier."""
+        primary = asyncio.ensure_future(first())
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                hedge = asyncio.ensure_future(second())
+                tasks.append(hedge)
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            hedged_requests.inc(result="won" if task is hedge else "lost")
+                            return task.result()
+                        if task is hedge and isinstance(task.exception(), SlotUnavailable):
+                            # no spare slot, the hedge must not take one from a user
+                            hedged_requests.inc(result="skipped")
+            # raises the error of the first request when both have failed
+            return await primary
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @classmethod
+    async def _request(
+            cls, url: str, operation: str, send: Send,
+            user_id: Optional[Hashable] = None, priority: Priority = Priority.PAGE, hedge: bool = False,
+    ):
+        """send(session, url, timeout) on the best mirror, a failure is retried on the next one.
+
+        Raises UpstreamError when every attempt has failed.
+        """
+        mirrors = cls.mirrors.ranked(cls.url)
+        # a prefetch is not worth more load on a struggling mirror
+        retries = 0 if priority is Priority.PREFETCH else cls.retries
+        hedge = hedge and cls.hedge_delay > 0
+        error = None
+        for attempt in range(retries + 1):
+            if attempt:
+                upstream_retries.inc(operation=operation)
+                # full jitter, retries of many requests failed together don't come back together
+                await asyncio.sleep(random.uniform(0, cls.backoff * 2 ** (attempt - 1)))
+            # with a single mirror it is the same host again
+            mirror = mirrors[attempt % len(mirrors)]
+            try:
+                if hedge:
+                    backup = mirrors[(attempt + 1) % len(mirrors)]
+                    return await cls._hedge(
+                        lambda: cls._attempt(url, mirror, operation, send, user_id, priority),
+                        lambda: cls._attempt(url, backup, operation, send, None, Priority.PREFETCH),
+                        cls.hedge_delay,
+                    )
+                return await cls._attempt(url, mirror, operation, send, user_id, priority)
+            except (ClientError, asyncio.TimeoutError) as last_error:
+                error = last_error
+        raise UpstreamError(f"{operation} {url} failed {retries + 1} times, last error: {error!r}") from error
+
+    @classmethod
+    async def async_fetch(cls, url, user_id: Optional[Hashable] = None, priority: Priority = Priority.PAGE) -> bytes:
+        # a coalesced request is charged to the user who started it
+        return await cls.inflight.do(url, lambda: cls._fetch(url, user_id, priority))
+
+    @classmethod
+    async def _fetch(cls, url, user_id: Optional[Hashable], priority: Priority) -> bytes:
+        async def send(session: ClientSession, url: str, timeout: ClientTimeout) -> bytes:
+            async with session.get(url, timeout=timeout) as response:
+                cls._check_status(response)
+                return await response.read()
+
+        return await cls._request(url, "page", send, user_id, priority, hedge=priority is Priority.PAGE)
 
     @classmethod
-    async def async_fetch(cls, url) -> bytes:
-        connector = ProxyConnector.from_url(PROXY, rdns=True)
-        async with ClientSession(headers=cls.headers, connector=connector) as session:
-            response = await session.get(url)
-            return await response.read()
+    @asynccontextmanager
+    async def async_download(cls, url, limit: int, user_id: Optional[Hashable] = None) -> AsyncIterator[DownloadedFile]:
+        """The downloaded file, closed when the last of the coalesced callers leaves the block."""
+        # counted before the first await, so a caller done early can't close the file under the others
+        task = cls.inflight.join(("download", url), lambda: cls._download(url, limit, user_id))
+        cls._download_users[task] += 1
+        try:
+            # shield: one impatient caller must not cancel the download for the others
+            yield await asyncio.shield(task)
+        finally:
+            cls._download_users[task] -= 1
+            if cls._download_users[task] <= 0:
+                if task.done():
+                    cls._close_unused(task)
+                else:
+                    # every caller has given up, the file is closed once it is there
+                    task.add_done_callback(cls._close_unused)
+
+    @classmethod
+    def _close_unused(cls, task: asyncio.Task):
+        if cls._download_users.get(task, 0) > 0:
+            # joined again while it was running
+            return
+        cls._download_users.pop(task, None)
+        if not task.cancelled() and task.exception() is None:
+            task.result().close()
+
+    @classmethod
+    async def _download(cls, url, limit: int, user_id: Optional[Hashable]) -> DownloadedFile:
+        async def send(session: ClientSession, url: str, timeout: ClientTimeout) -> DownloadedFile:
+            async with session.get(url, timeout=timeout) as response:
+                cls._check_status(response)
+                if response.content_length is not None and response.content_length >= limit:
+                    raise FileTooBigException(f"{url} is {response.content_length} bytes")
+                downloaded = DownloadedFile()
+                try:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        if downloaded.spills(chunk):
+                            # past the spool the writes go to the disk, keep them off the event loop
+                            await asyncio.to_thread(downloaded.write, chunk)
+                        else:
+                            downloaded.write(chunk)
+                        if downloaded.size >= limit:
+                            # content-length may be missing or wrong, stop as soon as the limit is crossed
+                            raise FileTooBigException(f"{url} is bigger than {limit} bytes")
+                except BaseException:
+                    # a broken transfer starts over on the next mirror
+                    downloaded.close()
+                    raise
+                return downloaded
+
+        downloaded = await cls._request(url, "download", send, user_id, Priority.DOWNLOAD)
+        download_bytes.observe(downloaded.size)
+        return downloaded
+
+    @classmethod
+    async def async_head(cls, url, priority: Priority = Priority.PREFETCH) -> tuple[int, Optional[int]]:
+        """Status and size of url without downloading it."""
+        async def send(session: ClientSession, url: str, timeout: ClientTimeout) -> tuple[int, Optional[int]]:
+            async with session.head(url, allow_redirects=True, timeout=timeout) as response:
+                cls._check_status(response)
+                return response.status, response.content_length
+
+        return await cls._request(url, "head", send, priority=priority)
+
+    @classmethod
+    async def async_download_to(cls, url, path: str, last_modified: Optional[str] = None) -> Optional[str]:
+        """Saves url to path unless it wasn't modified since last_modified.
+
+        Returns the new Last-Modified header, or None when the file is unchanged.
+        """
+        headers = {"If-Modified-Since": last_modified} if last_modified else {}
+
+        async def send(session: ClientSession, url: str, timeout: ClientTimeout) -> Optional[str]:
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                if response.status == 304:
+                    return None
+                response.raise_for_status()
+                # the dumps are big, the disk is written off the event loop
+                file = await asyncio.to_thread(open, path, 'wb')
+                try:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await asyncio.to_thread(file.write, chunk)
+                finally:
+                    await asyncio.to_thread(file.close)
+                return response.headers.get("Last-Modified", "")
+
+        return await cls._request(url, "dump", send, priority=Priority.DOWNLOAD)
 
 class InvalidLinkException(Exception):
     pass
 
+class BookFormat(IntEnum):
+    """Formats of the download links, /b/123/fb2, numbered to keep callback data short."""
+    fb2 = 1
+    epub = 2
+    mobi = 3
+    # the file as it was uploaded, whatever its format
+    download = 4
+    pdf = 5
+    djvu = 6
+    doc = 7
+    docx = 8
+    rtf = 9
+    txt = 10
+    html = 11
+
+class UpstreamError(Exception):
+    """Flibusta could not be reached: every mirror and retry has failed."""
+
+class FileTooBigException(Exception):
+    pass
+
+_html_parser = lxml.html.HTMLParser(encoding="utf-8")
+# everything the pages need lives inside div#main, the sidebar and the header are skipped
+_main_strainer = SoupStrainer('div', {'id': 'main'})
+_title_xpath = "h1[contains(concat(' ', normalize-space(@class), ' '), ' title ')]"
+
+
 class ParseMixin:
+    """Pages keep plain strings and ints in __slots__, nothing that points back into the parsed tree.
+
+    lxml attribute results (@href, @src) are smart strings holding their element, they must be
+    converted with str(). The soup is decomposed right after parsing, its tree is full of cycles
+    and would otherwise wait for the cyclic garbage collector.
+    """
+
+    __slots__ = ()
 
     doesnt_exist = "Does not exist"
 
@@ -37,9 +374,89 @@ class ParseMixin:
         _, letter, num = link.split('/')
         return f"/{letter}_{num}"
 
+    def _fields(self) -> dict:
+        # a page that doesn't exist leaves some slots unset
+        return {name: getattr(self, name) for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ())
+                if hasattr(self, name)}
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    @staticmethod
+    def _first(elements: list):
+        return elements[0] if elements else None
+
+    @classmethod
+    def from_html(cls, html: bytes, backend: str = PARSER_BACKEND):
+        # backends: "lxml" walks the tree with xpath, "soup" builds a BeautifulSoup of div#main only
+        if backend == "soup":
+            soup = BeautifulSoup(html, "lxml", parse_only=_main_strainer)
+            page = cls(soup)
+            soup.decompose()
+            return page
+        try:
+            root = lxml.html.document_fromstring(html, parser=_html_parser)
+        except ParserError:
+            # empty document
+            root = lxml.html.Element("html")
+        page = cls()
+        page._process_tree(root)
+        return page
+
+
+class PaginatedPage(ParseMixin):
+    """Result list shown by pages of page_size items, text(page) renders only that slice."""
+
+    __slots__ = ()
+
+    page_size = RESULTS_PAGE_SIZE
+
+    def _items_count(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def pages_count(self) -> int:
+        return max(1, -(-self._items_count() // self.page_size))
+
+    def _clamp_page(self, page: int) -> int:
+        return min(max(page, 0), self.pages_count - 1)
+
+    def page_links(self, page: int = 0) -> list[str]:
+        """Links of the items shown on the page, in order."""
+        raise NotImplementedError
+
+    def _page_footer(self, page: int) -> str:
+        if self.pages_count == 1:
+            return ""
+        return f"\nСтраница {page + 1} из {self.pages_count}\n"
+
 
 class BookPage(ParseMixin):
 
+    __slots__ = ('name', 'author_name', 'author_link', 'annotation', 'cover_link', 'size', 'links', 'num')
+
+    def _process_tree(self, root: lxml.html.HtmlElement):
+        _header = self._first(root.xpath(f"//{_title_xpath}"))
+        self.name = _header.text_content()
+        _author = self._first(_header.xpath("following-sibling::a[1]"))
+        if _author is None:
+            self.name = self.doesnt_exist
+            return
+        self.author_name = _author.text_content()
+        self.author_link = self._convert_link_to_tg(_author.get('href'))
+        _annotation = self._first(_header.xpath("following-sibling::p[1]"))
+        self.annotation = "Отсутствует." if _annotation is None else _annotation.text_content()
+        _cover_link = self._first(_header.xpath("following-sibling::img[1]/@src"))
+        self.cover_link = None if _cover_link is None else str(_cover_link)
+        _span_size = self._first(_header.xpath("following-sibling::div[1]//span[@style='size']"))
+        self.size = int(_span_size.text_content().split(', ')[0][:-1])
+        _links = _span_size.xpath("following-sibling::a/@href")
+        if len(_links) > 1:
+            _links = _links[1:]
+        self.links = [str(link) for link in _links]
+        self.num = int(self.links[0].split('/')[2])
 
     def _process_variables(self, soup: BeautifulSoup):
         _header = soup.find('h1', {'class': 'title'})
@@ -67,22 +484,37 @@ class BookPage(ParseMixin):
         self.links = [link.get('href') for link in _links_tags]
         self.num = int(self.links[0].split('/')[2])
 
-    def __init__(self, soup: BeautifulSoup):
+    def __init__(self, soup: BeautifulSoup = None):
         self.name = None
         self.author_name = None
         self.author_link = None
         self.annotation = None
         self.cover_link = None
+        self.size = None
         self.links = None
         self.num = None
-        self._process_variables(soup)
+        if soup is not None:
+            self._process_variables(soup)
 
     def text(self) -> str:
         result = f"{self.name}\n\n{self.author_name} {self.author_link}\n\nАннотация:\n\n{self.annotation}"
         return result
 
 
-class AuthorPage(ParseMixin):
+class AuthorPage(PaginatedPage):
+
+    __slots__ = ('name', 'books')
+
+    def _process_tree(self, root: lxml.html.HtmlElement):
+        _main = self._first(root.xpath("//div[@id='main']"))
+        self.name = self._first(_main.xpath(f".//{_title_xpath}")).text_content()
+        _form_post = self._first(_main.xpath(".//form[@method='POST']"))
+        if _form_post is None:
+            self.name = self.doesnt_exist
+            return
+        self.books = []
+        for a in _form_post.xpath(".//img/following-sibling::a[1]"):
+            self.books.append((a.text_content(), self._convert_link_to_tg(a.get('href'))))
 
     def _process_variables(self, soup: BeautifulSoup):
         _main = soup.find('div', {'id': 'main'})
@@ -92,24 +524,58 @@ class AuthorPage(ParseMixin):
             self.name = self.doesnt_exist
             return
         _imgs = _form_post.find_all('img')
-        self.books = [tag.find_next_sibling('a') for tag in _imgs]
+        self.books = []
+        for tag in _imgs:
+            a = tag.find_next_sibling('a')
+            self.books.append((a.text, self._convert_link_to_tg(a['href'])))
 
-    def __init__(self, soup: BeautifulSoup):
+    def __init__(self, soup: BeautifulSoup = None):
         self.name = None
         self.books = None
-        self._process_variables(soup)
+        if soup is not None:
+            self._process_variables(soup)
 
-    def text(self) -> str:
-        result = f"{self.name}\n\n"
-        for num, book in enumerate(self.books, start=1):
-            result += f"{num}) {book.text} {self._convert_link_to_tg(book['href'])}\n"
-        return result
+    def _items_count(self) -> int:
+        return len(self.books)
 
-class SearchPage(ParseMixin):
+    def page_links(self, page: int = 0) -> list[str]:
+        start = self._clamp_page(page) * self.page_size
+        return [link for _, link in self.books[start:start + self.page_size]]
 
-    def __init__(self, soup: BeautifulSoup):
-        _headers = soup.find_all('h3')
+    def text(self, page: int = 0) -> str:
+        page = self._clamp_page(page)
+        start = page * self.page_size
+        lines = [self.name, ""]
+        for num, (title, link) in enumerate(self.books[start:start + self.page_size], start=start + 1):
+            lines.append(f"{num}) {title} {link}")
+        return "\n".join(lines) + "\n" + self._page_footer(page)
+
+class SearchPage(PaginatedPage):
+
+    __slots__ = ('dict',)
+
+    def _process_tree(self, root: lxml.html.HtmlElement):
+        for h3 in root.xpath("//h3"):
+            header = h3.text_content().strip()
+            self.dict[header] = []
+            for li in h3.xpath("following-sibling::ul[1]//li"):
+                a = li.find('.//a')
+                self.dict[header].append(f"{a.text_content()} {self._convert_link_to_tg(a.get('href'))}")
+
+    def __init__(self, soup: BeautifulSoup = None):
         self.dict = {}
+        if soup is not None:
+            self._process_variables(soup)
+
+    @classmethod
+    def from_results(cls, results: dict[str, list[str]]) -> "SearchPage":
+        # results of the local catalogue, already in the shape of the parsed page
+        page = cls()
+        page.dict = results
+        return page
+
+    def _process_variables(self, soup: BeautifulSoup):
+        _headers = soup.find_all('h3')
         for h3 in _headers:
             lines = h3.find_next_sibling('ul').find_all('li')
             header = h3.text.strip()
@@ -118,43 +584,188 @@ class SearchPage(ParseMixin):
                 a = li.find('a')
                 self.dict[header].append(f"{a.text} {self._convert_link_to_tg(a.get('href'))}")
 
-    def text(self) -> str:
-        result = str()
+    def _items(self) -> Iterator[tuple]:
+        for header, values in self.dict.items():
+            for num, value in enumerate(values, start=1):
+                yield header, num, value
+
+    def _items_count(self) -> int:
+        return sum(len(values) for values in self.dict.values())
+
+    def page_links(self, page: int = 0) -> list[str]:
+        start = self._clamp_page(page) * self.page_size
+        return [value.rsplit(" ", 1)[-1] for _, _, value in islice(self._items(), start, start + self.page_size)]
+
+    def text(self, page: int = 0) -> str:
         if not self.dict:
             return "Ничего не найдено. Введите фамилию автора или название книги для поиска."
-        for key in self.dict.keys():
-            result += f"{key}\n\n"
-            for num, value in enumerate(self.dict[key], start=1):
-                result += f"{num}) {value}\n"
-            result += "\n"
-        return result
+        page = self._clamp_page(page)
+        start = page * self.page_size
+        parts = []
+        current_header = None
+        for header, num, value in islice(self._items(), start, start + self.page_size):
+            if header != current_header:
+                if current_header is not None:
+                    parts.append("\n")
+                parts.append(f"{header}\n\n")
+                current_header = header
+            parts.append(f"{num}) {value}\n")
+        parts.append("\n")
+        parts.append(self._page_footer(page))
+        return "".join(parts)
+
+
+def _timed_parse(page_cls, html: bytes) -> tuple:
+    # module level function, so process pool workers can unpickle it
+    start = time.perf_counter()
+    page = page_cls.from_html(html)
+    return page, time.perf_counter() - start
+
+
+class ParseExecutor:
+    """Runs page parsing off the event loop: in a thread pool, a process pool or inline."""
+
+    def __init__(self, kind: str = PARSE_EXECUTOR, workers: int = PARSE_WORKERS):
+        self.kind = kind
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+        self.queue_depth = 0
+        self.parsed = Counter()
+        self.parse_seconds = Counter()
+        self.wait_seconds = 0.0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                # the bot runs threads by now, a forked child could inherit a held lock
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="parser")
+        return self._executor
+
+    async def parse(self, page_cls, html: bytes):
+        start = time.perf_counter()
+        self.queue_depth += 1
+        try:
+            if self.kind == "inline":
+                page, seconds = _timed_parse(page_cls, html)
+            else:
+                loop = asyncio.get_running_loop()
+                page, seconds = await loop.run_in_executor(self._get_executor(), _timed_parse, page_cls, html)
+        finally:
+            self.queue_depth -= 1
+        self.parsed[page_cls.__name__] += 1
+        self.parse_seconds[page_cls.__name__] += seconds
+        parse_seconds.observe(seconds, page=page_cls.__name__)
+        self.wait_seconds += time.perf_counter() - start - seconds
+        return page
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
 
 
 class Flibusta(BaseRequest):
 
     pattern = re.compile(r"^/[ab]_\d+$")
+    cache = PageCache()
+    parser = ParseExecutor()
+    catalogue = Catalogue()
+
+    @classmethod
+    def _cache_ttl(cls, page: Union[BookPage, AuthorPage, SearchPage]) -> int:
+        if isinstance(page, SearchPage):
+            return CACHE_SEARCH_TTL if page.dict else CACHE_NEGATIVE_TTL
+        if page.name == page.doesnt_exist:
+            return CACHE_NEGATIVE_TTL
+        if isinstance(page, BookPage):
+            return CACHE_BOOK_TTL
+        return CACHE_AUTHOR_TTL
 
     @classmethod
-    async def get_search_text(cls, query: str) -> SearchPage:
+    async def get_search_text(cls, query: str, user_id: Optional[Hashable] = None) -> SearchPage:
+        key = cls.cache.search_key(query)
+        search_page = await cls.cache.load(key)
+        if search_page is None:
+            results = await cls.catalogue.search(query)
+            if results is not None:
+                search_page = SearchPage.from_results(results)
+            else:
+                # not in the local catalogue, or it is off: ask flibusta
+                search_page = await cls.inflight.do(key, lambda: cls._fetch_search_text(query, user_id))
+            await cls.cache.store(key, search_page, cls._cache_ttl(search_page))
+        return search_page
+
+    @classmethod
+    async def _fetch_search_text(cls, query: str, user_id: Optional[Hashable]) -> SearchPage:
         url = parse.urljoin(cls.url, f"booksearch?ask={query}&cha=on&chb=on")
-        resp = await cls.async_fetch(url)
-        soup = BeautifulSoup(resp, "lxml")
-        return SearchPage(soup)
+        resp = await cls.async_fetch(url, user_id)
+        return await cls.parser.parse(SearchPage, resp)
 
     @classmethod
-    async def get_page(cls, link: str) -> Union[BookPage, AuthorPage]:
+    async def refresh_catalogue(cls) -> bool:
+        """Downloads the sql dumps and merges them into the local catalogue, False if none changed."""
+        catalogue = cls.catalogue
+        # the dumps are big, creating and removing them is kept off the event loop too
+        directory = await asyncio.to_thread(
+            tempfile.mkdtemp, dir=os.path.dirname(os.path.abspath(catalogue.path)))
+        try:
+            dumps = {table: os.path.join(directory, name) for table, name in DUMPS.items()}
+            meta = {}
+            for table, name in DUMPS.items():
+                last_modified = await cls.async_download_to(
+                    parse.urljoin(cls.url, f"sql/{name}"), dumps[table],
+                    await asyncio.to_thread(catalogue.meta, f"{name}:last_modified"))
+                if last_modified is not None:
+                    meta[f"{name}:last_modified"] = last_modified
+            if not meta:
+                return False
+            # the index is built from all three dumps, fetch the unchanged ones too
+            for table, name in DUMPS.items():
+                if f"{name}:last_modified" not in meta:
+                    meta[f"{name}:last_modified"] = await cls.async_download_to(
+                        parse.urljoin(cls.url, f"sql/{name}"), dumps[table])
+            # parsing the dumps is pure python work, keep it away from the event loop and the GIL;
+            # spawn, forking a process that runs threads (parsers, resolver) can deadlock the child
+            executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            try:
+                await asyncio.get_running_loop().run_in_executor(executor, build_index, catalogue.path, dumps, meta)
+            finally:
+                await asyncio.to_thread(executor.shutdown)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, directory, True)
+        return True
+
+    @classmethod
+    async def get_page(
+            cls, link: str, user_id: Optional[Hashable] = None, priority: Priority = Priority.PAGE,
+    ) -> Union[BookPage, AuthorPage]:
         # links type /a_1234 or /b_234
         if not cls.pattern.match(link):
             raise InvalidLinkException(f"{link} is not acceptable.")
+        key = cls.cache.link_key(link)
+        page = await cls.cache.load(key)
+        if page is None:
+            try:
+                page = await cls.inflight.do(key, lambda: cls._fetch_page(link, user_id, priority))
+            except SlotUnavailable:
+                if priority is Priority.PREFETCH:
+                    raise
+                # joined a prefetch of the same page that found no free slot
+                page = await cls.inflight.do(key, lambda: cls._fetch_page(link, user_id, priority))
+            await cls.cache.store(key, page, cls._cache_ttl(page))
+        return page
+
+    @classmethod
+    async def _fetch_page(cls, link: str, user_id: Optional[Hashable], priority: Priority) -> Union[BookPage, AuthorPage]:
         letter, num = link.lstrip('/').split('_')
         link = link.replace('_', '/')
         if letter=='a':
             url = parse.urljoin(cls.url, f"{link}?lang=__&order=b&hg1=1&hg=1&sa1=1&hr1=1&hr=1")
-            resp = await cls.async_fetch(url)
-            soup = BeautifulSoup(resp,"lxml")
-            return AuthorPage(soup)
+            resp = await cls.async_fetch(url, user_id, priority)
+            return await cls.parser.parse(AuthorPage, resp)
         elif letter=='b':
             url = parse.urljoin(cls.url, link)
-            resp = await cls.async_fetch(url)
-            soup = BeautifulSoup(resp,"lxml")
-            return BookPage(soup)
+            resp = await cls.async_fetch(url, user_id, priority)
+            return await cls.parser.parse(BookPage, resp)
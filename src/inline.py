@@ -0,0 +1,128 @@
+"""Search as you type for inline queries: @bot чехов.
+
+Every keystroke is a new inline query. A query waits for debounce seconds and is cancelled
+when the same user types on, so only the last one reaches the search. A query that extends
+a finished one with complete results is answered by filtering them, without a request.
+"""
+import asyncio
+from typing import Hashable, Optional
+
+from aiogram.types import InlineQueryResultArticle, InputTextMessageContent
+from cachetools import TTLCache
+
+from flibusta import Flibusta, SearchPage
+from options import INLINE_DEBOUNCE, INLINE_BUDGET, INLINE_MIN_QUERY, INLINE_CACHE_SIZE, CACHE_SEARCH_TTL
+
+# flibusta and the catalogue show at most this many results in a section,
+# a shorter section is all there is for the query
+SECTION_LIMIT = 50
+# telegram accepts up to 50 results in one answer
+RESULTS_PER_ANSWER = 50
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).casefold().replace("ё", "е")
+
+
+def _matches(words: list[str], line: str) -> bool:
+    title = _normalize(line.rsplit(" ", 1)[0])
+    line_words = title.split()
+    return all(any(line_word.startswith(word) for line_word in line_words) for word in words)
+
+
+class InlineSearch:
+
+    def __init__(
+            self,
+            debounce: float = INLINE_DEBOUNCE,
+            budget: float = INLINE_BUDGET,
+            min_query: int = INLINE_MIN_QUERY,
+            cache_size: int = INLINE_CACHE_SIZE,
+            ttl: float = CACHE_SEARCH_TTL,
+    ):
+        self.debounce = debounce
+        # the whole answer, debounce included, must fit into it
+        self.budget = budget
+        self.min_query = min_query
+        # as fresh as the search pages of the page cache
+        self._pages = TTLCache(maxsize=cache_size, ttl=ttl)
+        self._pending: dict[Hashable, asyncio.Task] = {}
+        self.superseded = 0
+        self.timeouts = 0
+        self.prefix_hits = 0
+
+    @staticmethod
+    def _is_complete(page: SearchPage) -> bool:
+        return all(len(lines) < SECTION_LIMIT for lines in page.dict.values())
+
+    def _from_prefix(self, query: str) -> Optional[SearchPage]:
+        # the longest finished prefix wins, its results are the smallest superset
+        for end in range(len(query) - 1, self.min_query - 1, -1):
+            page = self._pages.get(query[:end])
+            if page is not None and self._is_complete(page):
+                words = query.split()
+                results = {}
+                for header, lines in page.dict.items():
+                    found = [line for line in lines if _matches(words, line)]
+                    if found:
+                        results[header] = found
+                if not results:
+                    # the catalogue and flibusta match word endings loosely, ask them
+                    return None
+                return SearchPage.from_results(results)
+        return None
+
+    async def _lookup(self, query: str, user_id: Optional[Hashable]) -> SearchPage:
+        await asyncio.sleep(self.debounce)
+        normalized = _normalize(query)
+        page = self._pages.get(normalized) or self._from_prefix(normalized)
+        if page is not None:
+            self.prefix_hits += 1
+        else:
+            # a timed out lookup still finishes the request, the page cache keeps it for the next keystroke
+            page = await Flibusta.get_search_text(query, user_id)
+        if page.dict:
+            # nothing found is left to the page cache and its shorter negative ttl
+            self._pages[normalized] = page
+        return page
+
+    async def search(self, query: str, user_id: Optional[Hashable] = None) -> Optional[SearchPage]:
+        """Results for the query, None when it was superseded by a newer query of the user.
+
+        Raises asyncio.TimeoutError when the budget runs out.
+        """
+        previous = self._pending.pop(user_id, None)
+        if previous is not None:
+            previous.cancel()
+        task = asyncio.ensure_future(asyncio.wait_for(self._lookup(query, user_id), self.budget))
+        self._pending[user_id] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                self.superseded += 1
+                return None
+            raise
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            if self._pending.get(user_id) is task:
+                del self._pending[user_id]
+
+
+def inline_results(page: SearchPage, offset: int = 0) -> tuple[list[InlineQueryResultArticle], str]:
+    """One answer worth of articles starting at offset, and the offset of the next answer."""
+    results = []
+    items = list(page._items())
+    for header, _, line in items[offset:offset + RESULTS_PER_ANSWER]:
+        title, link = line.rsplit(" ", 1)
+        results.append(InlineQueryResultArticle(
+            id=link,
+            title=title,
+            description=header.split(" (")[0],
+            # sends /b_123 or /a_123 to the chat, the bot answers it like a typed link
+            input_message_content=InputTextMessageContent(message_text=link),
+        ))
+    next_offset = offset + RESULTS_PER_ANSWER
+    return results, str(next_offset) if next_offset < len(items) else ""
@@ -0,0 +1,104 @@
+"""Offline load test of the whole fetch -> parse -> render path against the mock server.
+
+    python load_test.py --users 50 --rounds 20 --delay 0.05 [--no-cache]
+
+Every simulated user searches, opens the found author and then one of the books,
+rendering each page like the bot does. Prints throughput and latency percentiles.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from collections import defaultdict
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--delay", type=float, default=0.05, help="emulated upstream latency, seconds")
+    parser.add_argument("--no-cache", action="store_true", help="parse every page again")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace):
+    # options.py wants the bot environment, the load test talks only to the mock server
+    os.environ.setdefault("BOT_TOKEN", "0:load_test")
+    os.environ.setdefault("PROXY", "socks5://127.0.0.1:1080")
+    os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/load_test")
+    if args.no_cache:
+        for name in ("CACHE_BOOK_TTL", "CACHE_AUTHOR_TTL", "CACHE_SEARCH_TTL", "CACHE_NEGATIVE_TTL"):
+            os.environ[name] = "0"
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+async def user_session(flibusta, rounds: int, latencies: dict, rand: random.Random):
+    queries = ["Чехов", "чехов", "jsfksfjkdjkf"]
+    for _ in range(rounds):
+        start = time.perf_counter()
+        search_page = await flibusta.get_search_text(rand.choice(queries))
+        search_page.text()
+        latencies["search"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        author_page = await flibusta.get_page(rand.choice(["/a_10463", "/a_18862", "/a_1"]))
+        if author_page.name != author_page.doesnt_exist:
+            author_page.text()
+        latencies["author"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        book_page = await flibusta.get_page(rand.choice(["/b_531326", "/b_10501", "/b_807198", "/b_1"]))
+        if book_page.name != book_page.doesnt_exist:
+            book_page.text()
+        latencies["book"].append(time.perf_counter() - start)
+
+
+async def run(args: argparse.Namespace):
+    from flibusta import Flibusta
+    from mock_server import MockServer
+
+    rand = random.Random(args.seed)
+    latencies = defaultdict(list)
+    async with MockServer(delay=args.delay) as server:
+        Flibusta.url, Flibusta.proxy = server.url, None
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                user_session(Flibusta, args.rounds, latencies, random.Random(rand.random()))
+                for _ in range(args.users)
+            ))
+            duration = time.perf_counter() - start
+        finally:
+            await Flibusta.close_session()
+            Flibusta.parser.shutdown()
+        upstream_requests = server.requests
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"{total} lookups in {duration:.2f}s: {total / duration:.1f} lookups/s, {upstream_requests} upstream requests")
+    print(f"cache hits {Flibusta.cache.hits}, misses {Flibusta.cache.misses}")
+    print(f"{'lookup':<10}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, values in latencies.items():
+        values_ms = [value * 1000 for value in values]
+        print(
+            f"{name:<10}{len(values_ms):>8}{statistics.mean(values_ms):>10.1f}"
+            f"{percentile(values_ms, 50):>10.1f}{percentile(values_ms, 95):>10.1f}"
+            f"{percentile(values_ms, 99):>10.1f}{max(values_ms):>10.1f}"
+        )
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
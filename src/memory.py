@@ -0,0 +1,128 @@
+"""Memory diagnostics: RSS, live objects by type and tracemalloc snapshots diffed over time.
+
+MEMORY_TRACE=true starts tracemalloc, which costs some CPU and memory on every allocation,
+so it is off by default. RSS and object counts are cheap enough to report at any time.
+"""
+import asyncio
+import gc
+import logging
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Optional
+
+from options import MEMORY_TRACE, MEMORY_TRACE_FRAMES, MEMORY_REPORT_INTERVAL, MEMORY_REPORT_TOP
+
+logger = logging.getLogger("Bot logger.memory")
+
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes() -> int:
+    """Current resident set size, or the peak one where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _page_size
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macos
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def object_counts(top: int = MEMORY_REPORT_TOP) -> list[tuple[str, int]]:
+    """Most common types among the objects tracked by gc. Walks the whole heap, call it rarely."""
+    counts = Counter(type(obj).__qualname__ for obj in gc.get_objects())
+    return counts.most_common(top)
+
+
+class MemoryProfiler:
+    """Reports memory usage on an interval and on demand.
+
+    With tracemalloc on, every report also shows the source lines whose allocations
+    grew the most since the previous report.
+    """
+
+    def __init__(
+            self,
+            trace: bool = MEMORY_TRACE,
+            frames: int = MEMORY_TRACE_FRAMES,
+            interval: float = MEMORY_REPORT_INTERVAL,
+            top: int = MEMORY_REPORT_TOP,
+    ):
+        self.trace = trace
+        self.frames = frames
+        self.interval = interval
+        self.top = top
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        # reports run in threads, /memory and the interval report may overlap
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _filter(snapshot: tracemalloc.Snapshot) -> tracemalloc.Snapshot:
+        return snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+    def snapshot_diff(self) -> list[tracemalloc.StatisticDiff]:
+        """Biggest allocation changes since the previous call, empty on the first one."""
+        if not tracemalloc.is_tracing():
+            return []
+        snapshot = self._filter(tracemalloc.take_snapshot())
+        previous, self._snapshot = self._snapshot, snapshot
+        if previous is None:
+            return []
+        return snapshot.compare_to(previous, "lineno")[:self.top]
+
+    def report(self, objects: bool = False) -> str:
+        """Blocks for a while on a big heap, run it in a thread."""
+        with self._lock:
+            return self._report(objects)
+
+    def _report(self, objects: bool) -> str:
+        lines = [f"RSS: {rss_bytes() / 2 ** 20:.1f} MiB"]
+        lines.append(f"gc objects: {len(gc.get_objects())}, collections: {[s['collections'] for s in gc.get_stats()]}")
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"traced: {current / 2 ** 20:.1f} MiB, peak {peak / 2 ** 20:.1f} MiB")
+            diff = self.snapshot_diff()
+            if diff:
+                lines.append("")
+                lines.append("grown since the last report:")
+                lines.extend(str(stat) for stat in diff)
+        if objects:
+            lines.append("")
+            lines.append("objects by type:")
+            lines.extend(f"{name}: {count}" for name, count in object_counts(self.top))
+        return "\n".join(lines)
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            # snapshots and the heap walk take a while on a big heap, the event loop keeps going
+            logger.info("Memory report\n" + await asyncio.to_thread(self.report))
+
+    def start(self):
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            # the baseline for the first diff
+            self.snapshot_diff()
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._report_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._snapshot = None
@@ -0,0 +1,218 @@
+"""Small Prometheus-style metrics registry served as text on a local http port."""
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Optional
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(2 ** power * 1024 for power in range(0, 17, 2))  # 1 KiB .. 64 MiB
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return f"{{{pairs}}}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.label_names)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.label_names, key))
+
+    def samples(self) -> Iterable[tuple]:
+        """(name suffix, labels, value) triples."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[tuple]:
+        for key, value in self._values.items():
+            yield "", self._labels(key), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class CallbackMetric(Metric):
+    """Reads its value when scraped, for counters that already live somewhere else."""
+
+    def __init__(self, name: str, documentation: str, function: Callable, kind: str = "gauge", labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        # returns a number, or {label values tuple: number} when the metric has labels
+        self.function = function
+
+    def samples(self) -> Iterable[tuple]:
+        result = self.function()
+        if not self.label_names:
+            yield "", {}, result
+            return
+        for key, value in result.items():
+            key = key if isinstance(key, tuple) else (key,)
+            yield "", self._labels(key), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: dict[tuple, list] = {}
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def samples(self) -> Iterable[tuple]:
+        for key, counts in self._counts.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield "_bucket", {**labels, "le": le}, cumulative
+            yield "_count", labels, cumulative
+            yield "_sum", labels, self._sums[key]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def callback(self, name: str, documentation: str, function: Callable, kind: str = "gauge", labels: Iterable[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, function, kind, labels))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = Registry()
+
+fetch_seconds = registry.histogram(
+    "flibusta_fetch_seconds", "Time of requests to flibusta through the proxy", labels=("operation",))
+upstream_errors = registry.counter(
+    "flibusta_errors_total", "Failed requests to flibusta", labels=("operation", "error"))
+upstream_retries = registry.counter(
+    "flibusta_retries_total", "Requests to flibusta repeated after a failure", labels=("operation",))
+hedged_requests = registry.counter(
+    "flibusta_hedged_total", "Slow page requests sent to a second mirror: won, lost or skipped", labels=("result",))
+parse_seconds = registry.histogram(
+    "flibusta_parse_seconds", "Time spent parsing a page", labels=("page",))
+download_bytes = registry.histogram(
+    "flibusta_download_bytes", "Size of downloaded books", buckets=SIZE_BUCKETS)
+telegram_seconds = registry.histogram(
+    "telegram_request_seconds", "Time of Telegram Bot API calls, uploads included", labels=("method",))
+handler_seconds = registry.histogram(
+    "bot_handler_seconds", "Time spent in a handler", labels=("handler",))
+handler_errors = registry.counter(
+    "bot_handler_errors_total", "Handlers that raised", labels=("handler",))
+book_sends = registry.counter(
+    "bot_book_sends_total", "Books sent, by where the file came from", labels=("source",))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: time and errors of every handler, labeled with the handler function name."""
+
+    async def __call__(self, handler: Callable, event: Any, data: dict) -> Any:
+        name = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, handler=name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware: time of every Bot API call, document uploads included."""
+
+    async def __call__(self, make_request: Callable, bot: Bot, method: Any) -> Any:
+        with telegram_seconds.time(method=method.__api_method__):
+            return await make_request(bot, method)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> Optional[web.AppRunner]:
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
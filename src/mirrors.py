@@ -0,0 +1,95 @@
+"""Health and latency of the flibusta mirrors.
+
+Every request is routed to the fastest healthy mirror. A mirror that fails several times
+in a row is put aside for a cooldown and only tried when the healthy ones have failed too.
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+from aiohttp import ClientError
+
+from options import MIRROR_FAILURES, MIRROR_COOLDOWN
+
+# weight of the newest sample in the latency average
+LATENCY_WEIGHT = 0.3
+
+
+class Mirror:
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        # None until the first successful request, an unknown mirror is tried before the known slow ones
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.down_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.down_until <= time.monotonic()
+
+    def succeeded(self, latency: Optional[float] = None):
+        self.requests += 1
+        self.failures = 0
+        self.down_until = 0.0
+        if latency is not None:
+            self.latency = latency if self.latency is None else (
+                    LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * self.latency)
+
+    def failed(self, failures: int = MIRROR_FAILURES, cooldown: float = MIRROR_COOLDOWN):
+        self.requests += 1
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= failures:
+            self.down_until = time.monotonic() + cooldown
+
+
+class MirrorPool:
+
+    def __init__(self, urls: Iterable[str] = (), failures: int = MIRROR_FAILURES, cooldown: float = MIRROR_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._mirrors: dict[str, Mirror] = {}
+        self.extra = [url.rstrip('/') for url in urls if url]
+
+    def get(self, url: str) -> Mirror:
+        url = url.rstrip('/')
+        mirror = self._mirrors.get(url)
+        if mirror is None:
+            mirror = self._mirrors[url] = Mirror(url)
+        return mirror
+
+    def mirrors(self, primary: str) -> list[Mirror]:
+        urls = dict.fromkeys([primary.rstrip('/'), *self.extra])
+        return [self.get(url) for url in urls]
+
+    def ranked(self, primary: str) -> list[Mirror]:
+        """Healthy mirrors from the fastest, then the ones in cooldown from the soonest to recover."""
+        mirrors = self.mirrors(primary)
+        healthy = [mirror for mirror in mirrors if mirror.healthy]
+        healthy.sort(key=lambda mirror: mirror.latency or 0)
+        down = sorted((mirror for mirror in mirrors if not mirror.healthy), key=lambda mirror: mirror.down_until)
+        return healthy + down
+
+    @staticmethod
+    def rewrite(url: str, primary: str, mirror: Mirror) -> str:
+        """url of the primary host moved to the mirror, other urls are left alone."""
+        primary = primary.rstrip('/')
+        if url.startswith(primary):
+            return mirror.url + url[len(primary):]
+        return url
+
+    @contextmanager
+    def track(self, mirror: Mirror, latency: bool = True):
+        # downloads count for health only, their time depends on the size of the book
+        start = time.perf_counter()
+        try:
+            yield
+        except (ClientError, asyncio.TimeoutError):
+            mirror.failed(self.failures, self.cooldown)
+            raise
+        else:
+            mirror.succeeded(time.perf_counter() - start if latency else None)
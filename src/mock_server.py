@@ -0,0 +1,148 @@
+"""Local stand-in for flibusta that serves the pages saved in fixtures/.
+
+    python mock_server.py [port] [delay seconds]
+
+Point BaseRequest.url at it (and turn the proxy off) to run tests and load tests offline.
+"""
+import asyncio
+import gzip
+import os
+import re
+import sys
+from typing import Optional
+
+from aiohttp import web
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# booksearch?ask=... -> fixture, every other query finds nothing
+SEARCHES = {
+    "чехов": "search_chekhov.html",
+}
+
+_size_pattern = re.compile(rb"(\d+)K, ")
+
+
+class MockServer:
+
+    def __init__(self, fixtures: str = FIXTURES, host: str = "127.0.0.1", port: int = 0, delay: float = 0.0):
+        self.fixtures = fixtures
+        self.host = host
+        self.port = port
+        # emulates the latency of the proxy and the site
+        self.delay = delay
+        self.requests = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def _read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.fixtures, name), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _html(self, name: str, default: str) -> web.Response:
+        body = self._read(name) or self._read(default)
+        return web.Response(body=body, content_type="text/html", charset="utf-8")
+
+    async def _wait(self):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+    async def book(self, request: web.Request) -> web.Response:
+        await self._wait()
+        return self._html(f"book_{request.match_info['num']}.html", "book_nonexistent.html")
+
+    async def author(self, request: web.Request) -> web.Response:
+        await self._wait()
+        return self._html(f"author_{request.match_info['num']}.html", "author_nonexistent.html")
+
+    async def search(self, request: web.Request) -> web.Response:
+        await self._wait()
+        query = " ".join(request.query.get("ask", "").split()).casefold()
+        return self._html(SEARCHES.get(query, "search_empty.html"), "search_empty.html")
+
+    async def download(self, request: web.Request) -> web.StreamResponse:
+        await self._wait()
+        page = self._read(f"book_{request.match_info['num']}.html")
+        if page is None:
+            raise web.HTTPNotFound()
+        # as big as the book page says, sent without content-length like flibusta does
+        size = int(_size_pattern.search(page).group(1)) * 1024
+        response = web.StreamResponse()
+        response.content_type = "application/octet-stream"
+        if request.method == "HEAD":
+            # a HEAD check learns the size without the body
+            response.content_length = size
+            await response.prepare(request)
+            return response
+        await response.prepare(request)
+        chunk = b"0" * 64 * 1024
+        while size > 0:
+            await response.write(chunk[:size])
+            size -= len(chunk)
+        await response.write_eof()
+        return response
+
+    async def dump(self, request: web.Request) -> web.Response:
+        # fixtures/sql keeps the dumps uncompressed and readable, flibusta serves them gzipped
+        await self._wait()
+        path = os.path.join(self.fixtures, "sql", request.match_info["name"])
+        try:
+            modified = int(os.path.getmtime(path))
+        except FileNotFoundError:
+            raise web.HTTPNotFound()
+        since = request.if_modified_since
+        if since is not None and modified <= since.timestamp():
+            raise web.HTTPNotModified()
+        with open(path, "rb") as file:
+            response = web.Response(body=gzip.compress(file.read()), content_type="application/octet-stream")
+        response.last_modified = modified
+        return response
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/b/{num:\\d+}", self.book)
+        app.router.add_get("/b/{num:\\d+}/{format}", self.download)
+        app.router.add_get("/a/{num:\\d+}", self.author)
+        app.router.add_get("/booksearch", self.search)
+        app.router.add_get("/sql/{name}.gz", self.dump)
+        return app
+
+    async def start(self) -> str:
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> "MockServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+
+async def serve(port: int, delay: float):
+    async with MockServer(port=port, delay=delay) as server:
+        print(f"Mock flibusta is running on {server.url}")
+        await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(
+        port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+        delay=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0,
+    ))
@@ -9,6 +9,10 @@ if not BOT_TOKEN:
 PROXY = os.environ['PROXY']
 if not PROXY:
     raise ValueError('Missing proxy')
+FLIBUSTA_URL = os.environ.get('FLIBUSTA_URL', 'http://flibusta.is')
+# more hosts of the same library, comma separated: http://flibusta.site,http://flibusta...onion
+# an .onion host works when the proxy is a tor socks proxy, the names are resolved by the proxy
+FLIBUSTA_MIRRORS = [url.strip() for url in os.environ.get('FLIBUSTA_MIRRORS', '').split(',') if url.strip()]
 DATABASE_URL = os.environ['DATABASE_URL']
 if not DATABASE_URL:
     raise ValueError('Missing database url')
@@ -16,4 +20,115 @@ MESSAGE_LIMIT = 4096
 CAPTION_LIMIT = 1024
 TELEGRAM_LIMIT_MB = 50
 TELEGRAM_LIMIT_KILOS = TELEGRAM_LIMIT_MB * 1024
-TELEGRAM_LIMIT_BYTES = TELEGRAM_LIMIT_KILOS * 1024
\ No newline at end of file
+TELEGRAM_LIMIT_BYTES = TELEGRAM_LIMIT_KILOS * 1024
+
+HTTP_POOL_LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', 20))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 60))
+HTTP_DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', 300))
+
+PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 2000))
+# an author page can list thousands of books, so the pages are bounded by their estimated size too
+PAGE_CACHE_MB = int(os.environ.get('PAGE_CACHE_MB', 64))
+CACHE_BOOK_TTL = int(os.environ.get('CACHE_BOOK_TTL', 6 * 3600))
+CACHE_AUTHOR_TTL = int(os.environ.get('CACHE_AUTHOR_TTL', 3600))
+CACHE_SEARCH_TTL = int(os.environ.get('CACHE_SEARCH_TTL', 600))
+CACHE_NEGATIVE_TTL = int(os.environ.get('CACHE_NEGATIVE_TTL', 300))
+
+FILE_CACHE_DIR = os.environ.get('FILE_CACHE_DIR', '')
+FILE_CACHE_SIZE_MB = int(os.environ.get('FILE_CACHE_SIZE_MB', 1024))
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_SPOOL_BYTES = int(os.environ.get('DOWNLOAD_SPOOL_MB', 4)) * 1024 * 1024
+
+PARSER_BACKEND = os.environ.get('PARSER_BACKEND', 'lxml')
+
+# thread, process or inline
+PARSE_EXECUTOR = os.environ.get('PARSE_EXECUTOR', 'thread')
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 2))
+
+# concurrent requests through the proxy: in total, per user, for downloads and for prefetches
+UPSTREAM_LIMIT = int(os.environ.get('UPSTREAM_LIMIT', 16))
+UPSTREAM_USER_LIMIT = int(os.environ.get('UPSTREAM_USER_LIMIT', 2))
+UPSTREAM_DOWNLOAD_LIMIT = int(os.environ.get('UPSTREAM_DOWNLOAD_LIMIT', 8))
+UPSTREAM_PREFETCH_LIMIT = int(os.environ.get('UPSTREAM_PREFETCH_LIMIT', 2))
+
+# seconds: to connect, for a whole page, between two chunks of a download
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 10))
+UPSTREAM_PAGE_TIMEOUT = float(os.environ.get('UPSTREAM_PAGE_TIMEOUT', 20))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 60))
+# a failed request is repeated on the next mirror after a random pause of up to backoff * 2 ** retry
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', 0.5))
+# a page lookup slower than this gets a second request to the next mirror, 0 turns it off
+UPSTREAM_HEDGE_DELAY = float(os.environ.get('UPSTREAM_HEDGE_DELAY', 0))
+# failures in a row that put a mirror aside, and for how long
+MIRROR_FAILURES = int(os.environ.get('MIRROR_FAILURES', 3))
+MIRROR_COOLDOWN = float(os.environ.get('MIRROR_COOLDOWN', 60))
+
+# books or search results on one page of a paginated answer
+RESULTS_PAGE_SIZE = int(os.environ.get('RESULTS_PAGE_SIZE', 30))
+
+# users seen recently are not written to the database again
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 100000))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 24 * 3600))
+USER_FLUSH_SIZE = int(os.environ.get('USER_FLUSH_SIZE', 100))
+USER_FLUSH_INTERVAL = float(os.environ.get('USER_FLUSH_INTERVAL', 5))
+# uses of cached telegram files are counted in memory and written this often
+FILE_USES_FLUSH_INTERVAL = float(os.environ.get('FILE_USES_FLUSH_INTERVAL', 30))
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+# /metrics for prometheus, 0 turns it off
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9091))
+
+
+# redis://... shares the page cache and seen users between workers, memory:// or empty keeps them in the process
+SHARED_STORAGE_URL = os.environ.get('SHARED_STORAGE_URL', '')
+
+# polling or webhook; webhook can run several worker processes on one port
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise ValueError('Missing webhook url')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8080))
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 1))
+
+# memory diagnostics: tracemalloc is off by default, reports go to the log every interval (0 turns them off)
+MEMORY_TRACE = os.environ.get('MEMORY_TRACE', 'false').lower() == 'true'
+MEMORY_TRACE_FRAMES = int(os.environ.get('MEMORY_TRACE_FRAMES', 1))
+MEMORY_REPORT_INTERVAL = float(os.environ.get('MEMORY_REPORT_INTERVAL', 3600))
+MEMORY_REPORT_TOP = int(os.environ.get('MEMORY_REPORT_TOP', 10))
+
+# telegram ids allowed to use /memory, comma separated
+ADMIN_IDS = frozenset(int(user_id) for user_id in os.environ.get('ADMIN_IDS', '').split(',') if user_id.strip())
+
+# local search index built from the flibusta sql dumps, empty path turns it off
+CATALOGUE_PATH = os.environ.get('CATALOGUE_PATH', '')
+CATALOGUE_REFRESH_INTERVAL = float(os.environ.get('CATALOGUE_REFRESH_INTERVAL', 24 * 3600))
+CATALOGUE_SEARCH_LIMIT = int(os.environ.get('CATALOGUE_SEARCH_LIMIT', 50))
+
+# inline mode: pause before searching, time limit of an answer and how long telegram may cache it
+INLINE_DEBOUNCE = float(os.environ.get('INLINE_DEBOUNCE', 0.3))
+INLINE_BUDGET = float(os.environ.get('INLINE_BUDGET', 3))
+INLINE_MIN_QUERY = int(os.environ.get('INLINE_MIN_QUERY', 3))
+INLINE_CACHE_SIZE = int(os.environ.get('INLINE_CACHE_SIZE', 10000))
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 300))
+
+# prefetch of the first links of a served result list: links per answer (0 turns it off),
+# links per second with a burst allowance, and HEAD checks of the formats of a served book
+PREFETCH_TOP = int(os.environ.get('PREFETCH_TOP', 5))
+PREFETCH_RATE = float(os.environ.get('PREFETCH_RATE', 1))
+PREFETCH_BURST = int(os.environ.get('PREFETCH_BURST', 10))
+PREFETCH_FORMATS = os.environ.get('PREFETCH_FORMATS', 'false').lower() == 'true'
+# book pages fetched at startup: the most used books of the last days
+WARMUP_BOOKS = int(os.environ.get('WARMUP_BOOKS', 50))
+WARMUP_DAYS = int(os.environ.get('WARMUP_DAYS', 7))
@@ -0,0 +1,153 @@
+"""Warms the page cache for what users are likely to open next.
+
+After a result list is shown its first links are fetched, after a book page the download
+links can be checked with HEAD. Prefetches run at the lowest scheduler priority and never
+wait for a slot, a token bucket caps their rate, and a user's newer answer cancels the
+prefetch of the previous one.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Hashable, Iterable, Optional
+
+from cachetools import TTLCache
+
+from flibusta import Flibusta, BookPage, InvalidLinkException, UpstreamError
+from metrics import registry
+from options import PREFETCH_TOP, PREFETCH_RATE, PREFETCH_BURST, PREFETCH_FORMATS, CACHE_BOOK_TTL
+from scheduler import Priority, SlotUnavailable
+
+logger = logging.getLogger("Bot logger.prefetch")
+
+prefetches = registry.counter(
+    "flibusta_prefetches_total", "Prefetches by result: fetched, cached, skipped or failed", labels=("result",))
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Prefetcher:
+
+    def __init__(
+            self,
+            top: int = PREFETCH_TOP,
+            rate: float = PREFETCH_RATE,
+            burst: int = PREFETCH_BURST,
+            check_formats: bool = PREFETCH_FORMATS,
+    ):
+        self.top = top
+        self.check_formats = check_formats
+        self.budget = TokenBucket(rate, burst)
+        # (book id, format) -> (http status, size or None) of the download link
+        self.formats = TTLCache(maxsize=10000, ttl=CACHE_BOOK_TTL)
+        self._tasks: dict[Optional[Hashable], asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.top > 0
+
+    def _start(self, user_id: Optional[Hashable], jobs: list[Callable[[], Awaitable]], patient: bool = False):
+        previous = self._tasks.pop(user_id, None)
+        if previous is not None:
+            # the user has moved on, what wasn't fetched yet is no longer likely
+            previous.cancel()
+        if not jobs:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(jobs, patient))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda done: self._forget(user_id, done))
+
+    def _forget(self, user_id: Optional[Hashable], task: asyncio.Task):
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+
+    async def _run(self, jobs: list[Callable[[], Awaitable]], patient: bool):
+        # patient jobs (the warm-up) wait for the budget and pause while the slots are busy, the others give up
+        delay = 1 / self.budget.rate if self.budget.rate > 0 else 1
+        for left, job in zip(range(len(jobs), 0, -1), jobs):
+            while not self.budget.take():
+                if not patient or self.budget.rate <= 0:
+                    prefetches.inc(left, result="skipped")
+                    return
+                await asyncio.sleep(delay)
+            try:
+                await job()
+            except SlotUnavailable:
+                prefetches.inc(result="skipped")
+                if not patient:
+                    # foreground requests are busy, stop instead of adding to the load
+                    prefetches.inc(left - 1, result="skipped")
+                    return
+                await asyncio.sleep(delay)
+            except (UpstreamError, InvalidLinkException) as error:
+                prefetches.inc(result="failed")
+                logger.debug(f"Prefetch failed: {error!r}")
+            except Exception:
+                # best effort: an odd page the parser chokes on must not end the batch
+                prefetches.inc(result="failed")
+                logger.exception("Prefetch failed")
+            else:
+                prefetches.inc(result="fetched")
+
+    def _page_jobs(self, links: Iterable[str]) -> list[Callable[[], Awaitable]]:
+        jobs = []
+        for link in links:
+            if not Flibusta.pattern.match(link):
+                continue
+            if Flibusta.cache.link_key(link) in Flibusta.cache:
+                prefetches.inc(result="cached")
+                continue
+            jobs.append(lambda link=link: Flibusta.get_page(link, priority=Priority.PREFETCH))
+        return jobs
+
+    def prefetch_links(self, links: Iterable[str], user_id: Optional[Hashable] = None):
+        """Fetches the first links of a list the user has just been shown."""
+        if not self.enabled:
+            return
+        self._start(user_id, self._page_jobs(list(links)[:self.top]))
+
+    async def _check_format(self, book_id: int, book_format: str, link: str):
+        self.formats[(book_id, book_format)] = await Flibusta.async_head(f"{Flibusta.url}{link}")
+
+    def prefetch_formats(self, book_page: BookPage, user_id: Optional[Hashable] = None):
+        """HEAD-checks the download links of a book the user has just been shown."""
+        if not self.check_formats or not book_page.links:
+            return
+        jobs = []
+        for link in book_page.links:
+            book_format = link.split('/')[-1]
+            if (book_page.num, book_format) not in self.formats:
+                jobs.append(lambda book_format=book_format, link=link: self._check_format(book_page.num, book_format, link))
+        self._start(user_id, jobs)
+
+    def format_size(self, book_id: int, book_format: str) -> Optional[int]:
+        """Size of the download learned by a HEAD check, None if unknown."""
+        status, size = self.formats.get((book_id, book_format), (None, None))
+        return size if status == 200 else None
+
+    def warm_up(self, links: Iterable[str]):
+        """Fetches pages at startup, in the background, paced by the same budget."""
+        if self.enabled:
+            self._start("warm-up", self._page_jobs(links), patient=True)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
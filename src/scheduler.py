@@ -0,0 +1,138 @@
+import asyncio
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Hashable, Optional
+
+from options import UPSTREAM_LIMIT, UPSTREAM_USER_LIMIT, UPSTREAM_DOWNLOAD_LIMIT, UPSTREAM_PREFETCH_LIMIT
+
+
+class Priority(IntEnum):
+    # lower value is served first
+    PAGE = 0
+    DOWNLOAD = 1
+    # never waits: runs only in a free slot while nothing else is queued
+    PREFETCH = 2
+
+
+class SlotUnavailable(Exception):
+    pass
+
+
+class UpstreamScheduler:
+    """Limits concurrent upstream requests.
+
+    There is a global cap, a cap per user and a separate cap for downloads, so a big download
+    never takes the slots of quick page lookups. Waiting requests are served by priority,
+    and round-robin between users inside a priority, so one user can't starve the others.
+    """
+
+    def __init__(
+            self,
+            limit: int = UPSTREAM_LIMIT,
+            user_limit: int = UPSTREAM_USER_LIMIT,
+            download_limit: int = UPSTREAM_DOWNLOAD_LIMIT,
+            prefetch_limit: int = UPSTREAM_PREFETCH_LIMIT,
+    ):
+        self.limit = limit
+        self.user_limit = user_limit
+        self.limits = {Priority.DOWNLOAD: download_limit, Priority.PREFETCH: prefetch_limit}
+        self.active = 0
+        self.active_by_priority = Counter()
+        self.active_by_user = Counter()
+        self._queues: dict[Priority, OrderedDict[Hashable, deque]] = {priority: OrderedDict() for priority in Priority}
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(futures) for queue in self._queues.values() for futures in queue.values())
+
+    def _can_run(self, user_id: Optional[Hashable], priority: Priority) -> bool:
+        if self.active >= self.limit:
+            return False
+        if priority in self.limits and self.active_by_priority[priority] >= self.limits[priority]:
+            return False
+        # requests without a user (startup, background jobs) have only the global limits
+        return user_id is None or self.active_by_user[user_id] < self.user_limit
+
+    def _has_waiters(self, priority: Priority) -> bool:
+        # a waiter held back by its own user limit doesn't block the others
+        return any(
+            self._can_run(user_id, p)
+            for p in Priority if p <= priority
+            for user_id in self._queues[p]
+        )
+
+    def _take(self, user_id: Optional[Hashable], priority: Priority):
+        self.active += 1
+        self.active_by_priority[priority] += 1
+        if user_id is not None:
+            self.active_by_user[user_id] += 1
+
+    def _wake(self):
+        for priority in Priority:
+            queue = self._queues[priority]
+            woken = True
+            while woken and queue:
+                woken = False
+                for user_id in list(queue):
+                    if not self._can_run(user_id, priority):
+                        continue
+                    futures = queue[user_id]
+                    future = futures.popleft()
+                    if futures:
+                        queue.move_to_end(user_id)
+                    else:
+                        del queue[user_id]
+                    self._take(user_id, priority)
+                    future.set_result(None)
+                    woken = True
+                    break
+            if self.active >= self.limit:
+                return
+
+    def _remove(self, user_id: Optional[Hashable], priority: Priority, future: asyncio.Future):
+        queue = self._queues[priority]
+        futures = queue.get(user_id)
+        if futures is None:
+            return
+        try:
+            futures.remove(future)
+        except ValueError:
+            return
+        if not futures:
+            del queue[user_id]
+
+    async def acquire(self, user_id: Optional[Hashable] = None, priority: Priority = Priority.PAGE):
+        if not self._has_waiters(priority) and self._can_run(user_id, priority):
+            self._take(user_id, priority)
+            return
+        if priority is Priority.PREFETCH:
+            raise SlotUnavailable(f"no free slot for a prefetch, {self.active} active, {self.waiting} waiting")
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(user_id, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was given right before the cancellation
+                self.release(user_id, priority)
+            else:
+                self._remove(user_id, priority, future)
+            raise
+
+    def release(self, user_id: Optional[Hashable] = None, priority: Priority = Priority.PAGE):
+        self.active -= 1
+        self.active_by_priority[priority] -= 1
+        if user_id is not None:
+            self.active_by_user[user_id] -= 1
+            if not self.active_by_user[user_id]:
+                del self.active_by_user[user_id]
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[Hashable] = None, priority: Priority = Priority.PAGE):
+        await self.acquire(user_id, priority)
+        try:
+            yield
+        finally:
+            self.release(user_id, priority)
@@ -0,0 +1,107 @@
+"""Key-value storage for state shared between bot processes (page cache, seen users).
+
+SHARED_STORAGE_URL picks the backend: empty keeps everything in the process,
+memory:// is an in-process storage with the same interface, redis://... is shared by all
+workers and needs the optional redis package.
+"""
+import pickle
+import time
+from typing import Any, Optional
+
+from cachetools import LRUCache
+
+try:
+    from redis import asyncio as redis
+except ImportError:
+    redis = None
+
+from options import SHARED_STORAGE_URL
+
+
+class BaseStorage:
+
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: float):
+        raise NotImplementedError
+
+    async def add(self, key: str, ttl: float) -> bool:
+        """Marks the key as present, returns False if it already was."""
+        raise NotImplementedError
+
+    async def delete(self, *keys: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryStorage(BaseStorage):
+
+    def __init__(self, size: int = 100000):
+        # key -> (value, expires at)
+        self._data = LRUCache(maxsize=size)
+
+    def _get_entry(self, key: str) -> Optional[tuple]:
+        entry = self._data.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._get_entry(key)
+        return None if entry is None else entry[0]
+
+    async def set(self, key: str, value: Any, ttl: float):
+        self._data[key] = (value, time.monotonic() + ttl)
+
+    async def add(self, key: str, ttl: float) -> bool:
+        if self._get_entry(key) is not None:
+            return False
+        self._data[key] = (True, time.monotonic() + ttl)
+        return True
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._data.pop(key, None)
+
+
+class RedisStorage(BaseStorage):
+
+    def __init__(self, url: str, prefix: str = "flibusta:"):
+        if redis is None:
+            raise RuntimeError("SHARED_STORAGE_URL is redis, but the redis package is not installed")
+        self._client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[Any]:
+        data = await self._client.get(self.prefix + key)
+        return None if data is None else pickle.loads(data)
+
+    async def set(self, key: str, value: Any, ttl: float):
+        await self._client.set(self.prefix + key, pickle.dumps(value), px=int(ttl * 1000))
+
+    async def add(self, key: str, ttl: float) -> bool:
+        return bool(await self._client.set(self.prefix + key, b"1", px=int(ttl * 1000), nx=True))
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self._client.delete(*(self.prefix + key for key in keys))
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def create_storage(url: str = SHARED_STORAGE_URL) -> Optional[BaseStorage]:
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryStorage()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStorage(url)
+    raise ValueError(f"Unknown shared storage {url}")
+
+
+shared_storage = create_storage()
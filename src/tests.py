@@ -1,33 +1,44 @@
 import asyncio
+import os
+import pickle
+import shutil
+import socket
+import tempfile
+import time
 import unittest
-from unittest import TestCase
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import AsyncMock, MagicMock, patch
 
+# options.py wants the bot environment, the tests talk only to the local mock server
+os.environ.setdefault("BOT_TOKEN", "0:tests")
+os.environ.setdefault("PROXY", "socks5://127.0.0.1:1080")
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/tests")
+
+from aiohttp import ClientSession
+from bs4 import BeautifulSoup
 from parameterized import parameterized
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.util import greenlet_spawn
+
+import bot
+import db
+from cache import PageCache, SingleFlight, FileCache, estimate_size
+from catalogue import Catalogue, DUMPS, build_index, read_dump
+from db import UserMiddleware, FileUses, InstrumentedPool, pool_stats
+from flibusta import Flibusta, BookFormat, BookPage, AuthorPage, SearchPage, DownloadedFile, ParseExecutor, FileTooBigException, UpstreamError
+from inline import InlineSearch, inline_results
+from memory import MemoryProfiler, rss_bytes, object_counts
+from mirrors import MirrorPool
+from metrics import Registry, start_metrics_server, fetch_seconds, hedged_requests
+from mock_server import MockServer, FIXTURES
+from prefetch import Prefetcher
+from scheduler import Priority, SlotUnavailable, UpstreamScheduler
+from storage import MemoryStorage, create_storage
+
+books = ["/b_531326", "/b_10501", "/b_807198"]
 
-from flibusta import Flibusta, BookPage, AuthorPage
-
-books = [
-            "/b_531326", "/b_143909", "/b_531366", "/b_179296", "/b_10501", "/b_807198", "/b_178074", "/b_10500",
-             "/b_169388", "/b_169373", "/b_169387", "/b_169412", "/b_169357", "/b_169368", "/b_339196", "/b_531372",
-             "/b_531373", "/b_169502", "/b_169337", "/b_636443", "/b_169343", "/b_169473", "/b_10524", "/b_531375",
-             "/b_244150", "/b_169347", "/b_531374", "/b_638080", "/b_169372", "/b_415171", "/b_10514", "/b_169394",
-             "/b_82076", "/b_82073", "/b_757729", "/b_493844", "/b_424966", "/b_647643", "/b_10526", "/b_82081",
-             "/b_82079", "/b_167891", "/b_638669", "/b_10727", "/b_659063", "/b_727674", "/b_723104", "/b_337710",
-             "/b_435515", "/b_708495", "/b_169447", "/b_169458", "/b_601915", "/b_82101", "/b_124471", "/b_535957",
-             "/b_692321", "/b_734789", "/b_690376", "/b_707467", "/b_10733", "/b_367899", "/b_169466", "/b_169367",
-             "/b_531400", "/b_169356", "/b_531403", "/b_143910", "/b_169441", "/b_703532", "/b_169454", "/b_10741",
-             "/b_169451", "/b_169355", "/b_531381", "/b_531383", "/b_10726", "/b_531389", "/b_602186", "/b_604198",
-             "/b_169359", "/b_604205", "/b_531394", "/b_169265", "/b_234760", "/b_367898", "/b_169406", "/b_602286",
-             "/b_531397", "/b_169376", "/b_604920", "/b_169477", "/b_169363", "/b_169415", "/b_395619", "/b_169369",
-             "/b_601908", "/b_531404", "/b_10560", "/b_10559", "/b_234756", "/b_378978", "/b_10561", "/b_10562",
-             "/b_168419", "/b_801351", "/b_447416", "/b_531406", "/b_143911", "/b_473583", "/b_10534", "/b_10553",
-             "/b_531407", "/b_531408", "/b_82090", "/b_82089", "/b_601904", "/b_367891", "/b_10539", "/b_580736",
-             "/b_169409", "/b_143912", "/b_601973", "/b_82086", "/b_169442", "/b_169253", "/b_169450", "/b_169375",
-             "/b_447429", "/b_801154", "/b_531409", "/b_10545", "/b_16934", "/b_447430"
-         ]
-
-authors = [
-    '/a_303633', '/a_309182', '/a_217114', '/a_19245', '/a_267612', '/a_244522', '/a_229269', '/a_302205', '/a_310410', '/a_309803', '/a_264599', '/a_216090', '/a_157498', '/a_233764', '/a_301905', '/a_157503', '/a_92925', '/a_120423', '/a_124027', '/a_302870', '/a_253672', '/a_309184', '/a_230899', '/a_268646', '/a_189655', '/a_103654', '/a_12417', '/a_220773', '/a_198361', '/a_220751', '/a_306657', '/a_157504', '/a_273247', '/a_276466', '/a_162014', '/a_117538', '/a_236972', '/a_84483', '/a_112455', '/a_128763', '/a_245055', '/a_220699', '/a_220700', '/a_95031', '/a_220841', '/a_126418', '/a_250586', '/a_96806', '/a_266944', '/a_220914', '/a_238397', '/a_237106', '/a_99506', '/a_89518', '/a_236970', '/a_152764', '/a_220913', '/a_254416', '/a_33691', '/a_144593', '/a_220774', '/a_49547', '/a_238906', '/a_11010', '/a_157555', '/a_19243', '/a_262496', '/a_238186', '/a_104427', '/a_174391', '/a_302077', '/a_92642', '/a_160013', '/a_120262', '/a_298351', '/a_274522', '/a_98211', '/a_122119', '/a_226090', '/a_260343', '/a_55142', '/a_149452', '/a_281564', '/a_55553', '/a_235300', '/a_304459', '/a_96060', '/a_32907', '/a_136398', '/a_241214', '/a_220765', '/a_219675', '/a_207116', '/a_254703', '/a_189935', '/a_220101', '/a_61316', '/a_273136', '/a_55515', '/a_242789']
+authors = ["/a_10463", "/a_18862"]
 
 non_existent_books = [
     "/b_4474313",
@@ -41,44 +52,29 @@ non_existent_authors = [
     "/a_217113422432344",
 ]
 
-async def get_pages():
-    books_tasks = []
-    authors_tasks = []
-    nonexistent_books_tasks = []
-    nonexistent_authors_tasks = []
-    loop = asyncio.get_event_loop()
-    for link in books:
-        books_tasks.append(loop.create_task(Flibusta.get_page(link)))
-    for link in authors:
-        authors_tasks.append(loop.create_task(Flibusta.get_page(link)))
-    for link in non_existent_books:
-        nonexistent_books_tasks.append(loop.create_task(Flibusta.get_page(link)))
-    for link in non_existent_authors:
-        nonexistent_authors_tasks.append(loop.create_task(Flibusta.get_page(link)))
-    books_tasks = await asyncio.gather(*books_tasks)
-    authors_tasks = await asyncio.gather(*authors_tasks)
-    nonexistent_books_tasks = await asyncio.gather(*nonexistent_books_tasks)
-    nonexistent_authors_tasks = await asyncio.gather(*nonexistent_authors_tasks)
-    return books_tasks, authors_tasks, nonexistent_books_tasks, nonexistent_authors_tasks
-
-async def get_search_pages():
-    query = "Чехов"
-    query_non_exist = "jsfksfjkdjkf"
-
-    return await asyncio.gather(
-        Flibusta.get_search_text(query),
-        Flibusta.get_search_text(query_non_exist)
-    )
+def load_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as file:
+        return file.read()
+
+class MockFlibustaTestCase(IsolatedAsyncioTestCase):
 
-class ParserTests(TestCase):
+    async def asyncSetUp(self):
+        self.server = MockServer()
+        await self.server.start()
+        self._url, self._proxy = Flibusta.url, Flibusta.proxy
+        Flibusta.url, Flibusta.proxy = self.server.url, None
+        Flibusta.cache.clear()
 
-    book_pages, authors_pages, nonexistent_books_pages, nonexistent_authors_pages = asyncio.run(get_pages())
-    search_page, search_page_non_exist = asyncio.run(get_search_pages())
+    async def asyncTearDown(self):
+        await Flibusta.close_session()
+        Flibusta.url, Flibusta.proxy = self._url, self._proxy
+        await self.server.stop()
 
+class ParserTests(MockFlibustaTestCase):
 
-    @parameterized.expand([(page,) for page in book_pages])
-    def test_book_page(self, book_page: BookPage):
-        print(book_page.name, book_page.links)
+    @parameterized.expand([(link,) for link in books])
+    async def test_book_page(self, link):
+        book_page = await Flibusta.get_page(link)
         book_page.text()
         self.assertTrue(book_page.name)
         self.assertTrue(book_page.author_name)
@@ -87,32 +83,942 @@ class ParserTests(TestCase):
         self.assertTrue(book_page.num)
         self.assertIsInstance(book_page.num, int)
 
-    @parameterized.expand([(page,) for page in authors_pages])
-    def test_author_page(self, author_page: AuthorPage):
-        print(author_page.name)
+    @parameterized.expand([(link,) for link in books])
+    async def test_download_formats_are_known(self, link):
+        # unknown formats fall back to the long callback data
+        book_page = await Flibusta.get_page(link)
+        for download_link in book_page.links:
+            self.assertIn(download_link.split('/')[-1], BookFormat.__members__)
+
+    @parameterized.expand([(link,) for link in authors])
+    async def test_author_page(self, link):
+        author_page = await Flibusta.get_page(link)
         author_page.text()
         self.assertTrue(author_page.name)
         self.assertTrue(author_page.books)
 
-    @parameterized.expand([(page,) for page in nonexistent_books_pages])
-    def test_nonexistent_book_pages(self, book_page: BookPage):
+    @parameterized.expand([(link,) for link in non_existent_books])
+    async def test_nonexistent_book_pages(self, link):
+        book_page = await Flibusta.get_page(link)
         self.assertEqual(book_page.name, BookPage.doesnt_exist)
         self.assertFalse(book_page.author_name)
         self.assertFalse(book_page.author_link)
         self.assertFalse(book_page.links)
         self.assertFalse(book_page.num)
 
-    @parameterized.expand([(page,) for page in nonexistent_authors_pages])
-    def test_nonexistent_author_pages(self, author_page: AuthorPage):
+    @parameterized.expand([(link,) for link in non_existent_authors])
+    async def test_nonexistent_author_pages(self, link):
+        author_page = await Flibusta.get_page(link)
         self.assertEqual(author_page.name, AuthorPage.doesnt_exist)
         self.assertFalse(author_page.books)
 
+    async def test_search_pages(self):
+        search_page = await Flibusta.get_search_text("Чехов")
+        self.assertTrue(search_page.dict)
+        search_page.text()
+
+    async def test_search_page_non_exist(self):
+        search_page = await Flibusta.get_search_text("jsfksfjkdjkf")
+        self.assertFalse(search_page.dict)
+
+    async def test_concurrent_lookups_are_fetched_once(self):
+        pages = await asyncio.gather(*(Flibusta.get_page("/b_531326") for _ in range(10)))
+        await Flibusta.get_page("/b_531326")
+        self.assertEqual(self.server.requests, 1)
+        self.assertTrue(all(page is pages[0] for page in pages))
+
+class DownloadTests(MockFlibustaTestCase):
+
+    async def test_download(self):
+        async with Flibusta.async_download(f"{Flibusta.url}/b/10501/fb2", limit=1024 * 1024) as downloaded:
+            self.assertEqual(downloaded.size, 120 * 1024)
+        self.assertTrue(downloaded.closed)
+
+    async def test_too_big(self):
+        with self.assertRaises(FileTooBigException):
+            async with Flibusta.async_download(f"{Flibusta.url}/b/10501/fb2", limit=100 * 1024):
+                pass
+
+    async def test_coalesced_download_is_closed_by_the_last_caller(self):
+        url = f"{Flibusta.url}/b/10501/fb2"
+        first_done = asyncio.Event()
+        files = []
+
+        async def download(wait: bool):
+            async with Flibusta.async_download(url, limit=1024 * 1024) as downloaded:
+                files.append(downloaded)
+                if wait:
+                    await first_done.wait()
+                    # the other caller has left, the file is still readable
+                    self.assertEqual(sum(len(chunk) for chunk in downloaded.chunks()), 120 * 1024)
+                else:
+                    first_done.set()
+
+        await asyncio.gather(download(True), download(False))
+        self.assertIs(files[0], files[1])
+        self.assertTrue(files[0].closed)
+        self.assertEqual(self.server.requests, 1)
+        self.assertFalse(Flibusta._download_users)
+
+class MirrorTests(MockFlibustaTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            # nothing listens there once the socket is closed
+            self.dead_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+        self._mirrors, self._backoff, self._hedge_delay = Flibusta.mirrors, Flibusta.backoff, Flibusta.hedge_delay
+        Flibusta.backoff = 0
+
+    async def asyncTearDown(self):
+        Flibusta.mirrors, Flibusta.backoff, Flibusta.hedge_delay = self._mirrors, self._backoff, self._hedge_delay
+        await super().asyncTearDown()
+
+    def test_ranking(self):
+        pool = MirrorPool(["http://b", "http://c"])
+        pool.get("http://a").succeeded(0.5)
+        pool.get("http://b").succeeded(0.1)
+        pool.get("http://c").failed(failures=1)
+        self.assertEqual([mirror.url for mirror in pool.ranked("http://a/")], ["http://b", "http://a", "http://c"])
+        self.assertEqual(pool.rewrite("http://a/b_1", "http://a", pool.get("http://b")), "http://b/b_1")
+
+    async def test_failover(self):
+        Flibusta.url = self.dead_url
+        Flibusta.mirrors = MirrorPool([self.server.url], failures=1)
+        book_page = await Flibusta.get_page("/b_531326")
+        self.assertTrue(book_page.name)
+        self.assertFalse(Flibusta.mirrors.get(self.dead_url).healthy)
+        # the next request goes straight to the healthy mirror
+        Flibusta.cache.clear()
+        await Flibusta.get_page("/b_10501")
+        self.assertEqual(Flibusta.mirrors.get(self.dead_url).requests, 1)
+        async with Flibusta.async_download(f"{Flibusta.url}/b/10501/fb2", limit=1024 * 1024) as downloaded:
+            self.assertEqual(downloaded.size, 120 * 1024)
+
+    async def test_all_mirrors_down(self):
+        Flibusta.url = self.dead_url
+        Flibusta.mirrors = MirrorPool()
+        with self.assertRaises(UpstreamError):
+            await Flibusta.get_page("/b_531326")
+        with self.assertRaises(UpstreamError):
+            async with Flibusta.async_download(f"{Flibusta.url}/b/10501/fb2", limit=1024 * 1024):
+                pass
+        self.assertEqual(Flibusta.mirrors.get(self.dead_url).errors, 2 * (Flibusta.retries + 1))
+
+    async def test_hedged_request(self):
+        fast = MockServer()
+        await fast.start()
+        try:
+            self.server.delay = 1
+            Flibusta.mirrors = MirrorPool([fast.url])
+            Flibusta.hedge_delay = 0.05
+            won = hedged_requests.value(result="won")
+            start = time.monotonic()
+            await Flibusta.get_page("/b_531326")
+            self.assertLess(time.monotonic() - start, 0.5)
+            self.assertEqual(hedged_requests.value(result="won"), won + 1)
+            self.assertEqual(fast.requests, 1)
+            # the slow request was cancelled and gave its slot back
+            self.assertEqual(Flibusta.scheduler.active, 0)
+        finally:
+            await fast.stop()
+
+class FailingSession:
+    """Session of a database that is down."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, *args, **kwargs):
+        raise SQLAlchemyError("database is down")
+
+def callback_query(data: str = "") -> SimpleNamespace:
+    return SimpleNamespace(
+        data=data,
+        message=SimpleNamespace(chat=SimpleNamespace(id=1)),
+        from_user=SimpleNamespace(id=1, username="user"),
+        answer=AsyncMock(),
+    )
+
+class BookDeliveryTests(MockFlibustaTestCase):
+
+    async def test_database_outage_is_a_cache_miss(self):
+        with patch.object(db, "Session", FailingSession), patch.object(bot.bot, "send_document", AsyncMock()) as send:
+            with self.assertLogs("Bot logger", "ERROR"):
+                self.assertFalse(await bot.send_cached_book(callback_query(), 10501, "fb2"))
+        send.assert_not_called()
+
+    async def test_failed_file_id_save_keeps_the_upload(self):
+        sent = SimpleNamespace(document=SimpleNamespace(file_id="file", file_size=1))
+        with patch.object(db, "Session", FailingSession), patch.object(bot.bot, "send_document", AsyncMock(return_value=sent)):
+            with self.assertLogs("Bot logger", "ERROR"):
+                await bot.upload_book(callback_query(), 10501, "fb2", MagicMock())
+
+class DownloadCallbackTests(MockFlibustaTestCase):
+
+    def test_pack_and_unpack(self):
+        data = bot.DownloadCallback(book_id=531326, book_format=BookFormat.epub).pack()
+        self.assertEqual(data, "d:531326:2")
+        callback_data = bot.DownloadCallback.unpack(data)
+        self.assertEqual((callback_data.book_id, callback_data.book_format), (531326, BookFormat.epub))
+
+    def test_fits_telegram_limit(self):
+        longest = max(BookFormat, key=lambda book_format: len(str(book_format.value)))
+        data = bot.DownloadCallback(book_id=2 ** 63 - 1, book_format=longest).pack()
+        self.assertLessEqual(len(data.encode()), 64)
+
+    def test_unknown_format_keeps_the_link(self):
+        book_page = BookPage()
+        book_page.num = 531326
+        book_page.links = ["/b/531326/fb2", "/b/531326/azw3"]
+        buttons = [button for row in bot.get_download_markup(book_page).inline_keyboard for button in row]
+        self.assertEqual(
+            [(button.text, button.callback_data) for button in buttons],
+            [("fb2", "d:531326:1"), ("azw3", "/b/531326/azw3")],
+        )
+
+    async def test_old_buttons_are_answered(self):
+        with patch.object(bot, "send_book", AsyncMock()) as send_book:
+            await bot.download_link_handler(callback_query("/b/531326/fb2"))
+        send_book.assert_awaited_once()
+        self.assertEqual(send_book.await_args.args[1:], (531326, "fb2"))
+
+    async def test_book_name_miss_reads_the_page(self):
+        bot.book_names.clear()
+        self.assertEqual(await bot.get_book_name(10501, user_id=1), (await Flibusta.get_page("/b_10501")).name)
+        self.assertIn(10501, bot.book_names)
+        requests = self.server.requests
+        await bot.get_book_name(10501, user_id=1)
+        self.assertEqual(self.server.requests, requests)
+
+class PageCacheTests(TestCase):
+
+    def test_hit_and_miss(self):
+        cache = PageCache(size=10)
+        key = cache.link_key("/b_531326")
+        self.assertIsNone(cache.get(key))
+        cache.set(key, "page", ttl=60)
+        self.assertEqual(cache.get(key), "page")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_search_key_is_normalized(self):
+        self.assertEqual(PageCache.search_key("  Чехов  Антон "), PageCache.search_key("чехов антон"))
+
+    def test_expired_entry(self):
+        cache = PageCache(size=10)
+        cache.set("key", "page", ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("key"))
+
+    def test_zero_ttl_is_not_stored(self):
+        cache = PageCache(size=10)
+        cache.set("key", "page", ttl=0)
+        self.assertEqual(len(cache), 0)
+
+    def test_size_bound(self):
+        cache = PageCache(size=2)
+        for num in range(5):
+            cache.set(num, num, ttl=60)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(4), 4)
+
+    def test_bytes_bound(self):
+        big, small = AuthorPage(), AuthorPage()
+        big.name, big.books = "Автор", [(f"Книга {num}", f"/b_{num}") for num in range(1800)]
+        small.name, small.books = "Автор", [("Книга", "/b_1")]
+        cache = PageCache(size=100, max_bytes=estimate_size(big) + 10 * estimate_size(small), storage=None)
+        cache.set("big", big, ttl=60)
+        for num in range(20):
+            cache.set(num, small, ttl=60)
+        # the big page went out first, the entry count is still far from its bound
+        self.assertIsNone(cache.get("big"))
+        self.assertEqual(cache.get(19), small)
+        self.assertLessEqual(cache.bytes, estimate_size(big) + 10 * estimate_size(small))
+        self.assertGreater(estimate_size(big), 100 * estimate_size(small))
+
+    def test_too_big_page_isnt_cached(self):
+        page = AuthorPage()
+        page.name, page.books = "Автор", [("Книга", "/b_1")] * 100
+        cache = PageCache(max_bytes=estimate_size(page) - 1, storage=None)
+        cache.set("page", page, ttl=60)
+        self.assertIsNone(cache.get("page"))
+        self.assertEqual(len(cache), 0)
+
+class SharedStorageTests(IsolatedAsyncioTestCase):
+
+    async def test_memory_storage(self):
+        storage = MemoryStorage()
+        self.assertIsNone(await storage.get("key"))
+        await storage.set("key", {"page": 1}, ttl=60)
+        self.assertEqual(await storage.get("key"), {"page": 1})
+        await storage.set("short", "page", ttl=0.01)
+        await asyncio.sleep(0.02)
+        self.assertIsNone(await storage.get("short"))
+
+    async def test_add_marks_key_once(self):
+        storage = MemoryStorage()
+        self.assertTrue(await storage.add("user:1", ttl=60))
+        self.assertFalse(await storage.add("user:1", ttl=60))
+        await storage.delete("user:1")
+        self.assertTrue(await storage.add("user:1", ttl=60))
+
+    def test_create_storage(self):
+        self.assertIsNone(create_storage(""))
+        self.assertIsInstance(create_storage("memory://"), MemoryStorage)
+        with self.assertRaises(ValueError):
+            create_storage("ftp://localhost")
+
+    async def test_workers_share_pages(self):
+        storage = MemoryStorage()
+        first, second = PageCache(size=10, storage=storage), PageCache(size=10, storage=storage)
+        key = first.link_key("/b_531326")
+        await first.store(key, "page", ttl=60)
+        self.assertEqual(await second.load(key), "page")
+        self.assertEqual((second.hits, second.shared_hits, second.misses), (1, 1, 0))
+        # now it is in the local cache of the second worker too
+        self.assertEqual(second.get(key), "page")
+
+    async def test_workers_save_user_once(self):
+        storage = MemoryStorage()
+        first, second = UserMiddleware(storage=storage), UserMiddleware(storage=storage)
+        user = dict(user_id=1, username="user1", name="Name", language_code="ru")
+        self.assertEqual(await first._claim({1: user}), {1: user})
+        self.assertEqual(await second._claim({1: user}), {})
+
+class SingleFlightTests(TestCase):
+
+    def test_concurrent_calls_are_coalesced(self):
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return b"book"
+
+        async def run():
+            flight = SingleFlight()
+            results = await asyncio.gather(*(flight.do("/b/1/fb2", fetch) for _ in range(10)))
+            return flight, results
+
+        flight, results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b"book"] * 10)
+        self.assertEqual(flight.shared, 9)
+        self.assertEqual(len(flight), 0)
+
+    def test_error_is_shared(self):
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise ValueError
+
+        async def run():
+            flight = SingleFlight()
+            return await asyncio.gather(flight.do(1, fetch), flight.do(1, fetch), return_exceptions=True)
+
+        for result in asyncio.run(run()):
+            self.assertIsInstance(result, ValueError)
+
+def downloaded_file(data: bytes, spool_size: int = 1024) -> DownloadedFile:
+    downloaded = DownloadedFile(spool_size=spool_size)
+    for start in range(0, len(data), 100):
+        downloaded.write(data[start:start + 100])
+    return downloaded
+
+class DownloadedFileTests(TestCase):
+
+    def test_readers_keep_own_offset(self):
+        data = bytes(range(256)) * 20
+        downloaded = downloaded_file(data)
+        first, second = downloaded.chunks(300), downloaded.chunks(300)
+        self.assertEqual(next(first), data[:300])
+        self.assertEqual(b"".join(second), data)
+        self.assertEqual(b"".join(first), data[300:])
+        self.assertEqual(downloaded.size, len(data))
+
+    def test_spills(self):
+        downloaded = DownloadedFile(spool_size=200)
+        self.assertFalse(downloaded.spills(b"x" * 200))
+        downloaded.write(b"x" * 150)
+        self.assertTrue(downloaded.spills(b"x" * 100))
+
+class FileCacheTests(TestCase):
+
+    def test_put_and_get(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileCache(directory, size_mb=1)
+            asyncio.run(cache.put(1, "fb2", downloaded_file(b"book")))
+            path = asyncio.run(cache.get(1, "fb2"))
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), b"book")
+            self.assertIsNone(asyncio.run(cache.get(1, "epub")))
+
+    def test_oldest_files_are_evicted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileCache(directory, size_mb=1)
+            half = downloaded_file(b"x" * (cache.max_bytes // 2))
+            asyncio.run(cache.put(1, "fb2", half))
+            os.utime(os.path.join(directory, "1.fb2"), (0, 0))
+            asyncio.run(cache.put(2, "fb2", half))
+            asyncio.run(cache.put(3, "fb2", half))
+            self.assertIsNone(asyncio.run(cache.get(1, "fb2")))
+            self.assertTrue(asyncio.run(cache.get(3, "fb2")))
+
+    def test_concurrent_puts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileCache(directory, size_mb=1)
+
+            async def put_together():
+                await asyncio.gather(*(cache.put(1, "fb2", downloaded_file(b"book")) for _ in range(5)))
+
+            with patch.object(cache, "_write", wraps=cache._write) as write:
+                asyncio.run(put_together())
+            self.assertEqual(os.listdir(directory), ["1.fb2"])
+            self.assertEqual(write.call_count, 1)
+
+    def test_same_file_is_not_written_again(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileCache(directory, size_mb=1)
+            book = downloaded_file(b"book")
+            asyncio.run(cache.put(1, "fb2", book))
+            path = os.path.join(directory, "1.fb2")
+            os.utime(path, (0, 0))
+            with patch.object(os, "replace") as replace:
+                asyncio.run(cache.put(1, "fb2", book))
+            replace.assert_not_called()
+            # still counts as used for the eviction
+            self.assertGreater(os.path.getmtime(path), 0)
+
+    def test_disabled(self):
+        cache = FileCache("", size_mb=1)
+        asyncio.run(cache.put(1, "fb2", downloaded_file(b"book")))
+        self.assertIsNone(asyncio.run(cache.get(1, "fb2")))
+
+fixture_pages = [
+    ("book_531326.html", BookPage),
+    ("book_10501.html", BookPage),
+    ("book_807198.html", BookPage),
+    ("book_nonexistent.html", BookPage),
+    ("author_18862.html", AuthorPage),
+    ("author_10463.html", AuthorPage),
+    ("author_nonexistent.html", AuthorPage),
+    ("search_chekhov.html", SearchPage),
+    ("search_empty.html", SearchPage),
+]
+
+class ParserBackendTests(TestCase):
+
+    @parameterized.expand(fixture_pages)
+    def test_backends_are_equal(self, name, page_cls):
+        html = load_fixture(name)
+        full_soup_page = page_cls(BeautifulSoup(html, "lxml"))
+        self.assertEqual(page_cls.from_html(html, backend="soup"), full_soup_page)
+        self.assertEqual(page_cls.from_html(html, backend="lxml"), full_soup_page)
+
+    def test_book_page(self):
+        book_page = BookPage.from_html(load_fixture("book_531326.html"))
+        self.assertEqual(book_page.author_link, "/a_18862")
+        self.assertEqual(book_page.links, ["/b/531326/fb2", "/b/531326/epub", "/b/531326/mobi"])
+        self.assertEqual(book_page.num, 531326)
+        self.assertEqual(book_page.size, 1588)
+
+    def test_empty_document(self):
+        self.assertFalse(SearchPage.from_html(b"").dict)
+
+    @parameterized.expand(fixture_pages)
+    def test_pages_hold_plain_values(self, name, page_cls):
+        page = page_cls.from_html(load_fixture(name))
+        self.assertFalse(hasattr(page, "__dict__"))
+        # lxml smart strings would keep the whole document alive in the page cache
+        for value in page._fields().values():
+            self.assertIn(type(value), (str, int, list, dict, type(None)))
+        self.assertEqual(pickle.loads(pickle.dumps(page)), page)
+
+    def test_cover_link_is_str(self):
+        book_page = BookPage.from_html(load_fixture("book_531326.html"))
+        self.assertIs(type(book_page.cover_link), str)
+
+class PaginationTests(TestCase):
+
+    def test_author_pages(self):
+        author_page = AuthorPage.from_html(load_fixture("author_10463.html"))
+        self.assertEqual(author_page.pages_count, -(-len(author_page.books) // AuthorPage.page_size))
+        second = author_page.text(1)
+        title, link = author_page.books[AuthorPage.page_size]
+        self.assertIn(f"{AuthorPage.page_size + 1}) {title} {link}", second)
+        self.assertNotIn(f"1) {author_page.books[0][0]} ", second)
+        self.assertIn(f"Страница 2 из {author_page.pages_count}", second)
+        self.assertEqual(author_page.text(10 ** 6), author_page.text(author_page.pages_count - 1))
+
+    def test_single_page_has_no_footer(self):
+        author_page = AuthorPage()
+        author_page.name, author_page.books = "Автор", [("Книга", "/b_1"), ("Другая", "/b_2")]
+        self.assertEqual(author_page.text(), "Автор\n\n1) Книга /b_1\n2) Другая /b_2\n")
+
     def test_search_pages(self):
-        self.assertTrue(self.search_page.dict)
-        self.search_page.text()
+        search_page = SearchPage.from_html(load_fixture("search_chekhov.html"))
+        self.assertEqual(search_page.pages_count, 2)
+        first, second = search_page.text(0), search_page.text(1)
+        self.assertTrue(first.startswith("Найденные писатели (3):\n\n1) Чехов Антон Павлович /a_10463\n"))
+        # the header of a section split between pages is repeated
+        self.assertTrue(second.startswith("Найденные книги (50):\n\n"))
+        self.assertEqual(first.count(") ") + second.count(") "), 53)
+
+class ParseExecutorTests(TestCase):
+
+    @parameterized.expand([("inline",), ("thread",), ("process",)])
+    def test_parse(self, kind):
+        html = load_fixture("author_18862.html")
+        executor = ParseExecutor(kind=kind, workers=1)
+        try:
+            author_page = asyncio.run(executor.parse(AuthorPage, html))
+        finally:
+            executor.shutdown()
+        self.assertEqual(author_page, AuthorPage.from_html(html))
+        self.assertEqual(executor.parsed["AuthorPage"], 1)
+        self.assertEqual(executor.queue_depth, 0)
+
+class UpstreamSchedulerTests(IsolatedAsyncioTestCase):
+
+    async def run_requests(self, scheduler: UpstreamScheduler, requests: list) -> list:
+        """Runs (user_id, priority) requests that hold their slot for a moment, returns the start order."""
+        order = []
+
+        async def request(num, user_id, priority):
+            async with scheduler.slot(user_id, priority):
+                order.append(num)
+                self.assertLessEqual(scheduler.active, scheduler.limit)
+                self.assertLessEqual(scheduler.active_by_user[user_id], scheduler.user_limit)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(request(num, *args) for num, args in enumerate(requests)))
+        self.assertEqual(scheduler.active, 0)
+        self.assertEqual(scheduler.waiting, 0)
+        return order
+
+    async def test_users_are_served_in_turn(self):
+        scheduler = UpstreamScheduler(limit=1, user_limit=1, download_limit=1)
+        order = await self.run_requests(scheduler, [("a", Priority.PAGE)] * 4 + [("b", Priority.PAGE)])
+        self.assertLess(order.index(4), order.index(2))
+
+    async def test_pages_go_before_downloads(self):
+        scheduler = UpstreamScheduler(limit=1, user_limit=5, download_limit=1)
+        order = await self.run_requests(scheduler, [("a", Priority.DOWNLOAD)] * 3 + [("b", Priority.PAGE)])
+        self.assertEqual(order[:2], [0, 3])
+
+    async def test_downloads_leave_slots_for_pages(self):
+        scheduler = UpstreamScheduler(limit=3, user_limit=5, download_limit=1)
+        await scheduler.acquire("a", Priority.DOWNLOAD)
+        await asyncio.wait_for(scheduler.acquire("b", Priority.PAGE), 1)
+        download = asyncio.ensure_future(scheduler.acquire("c", Priority.DOWNLOAD))
+        await asyncio.sleep(0.01)
+        self.assertFalse(download.done())
+        scheduler.release("a", Priority.DOWNLOAD)
+        await asyncio.wait_for(download, 1)
+
+    async def test_prefetch_never_waits(self):
+        scheduler = UpstreamScheduler(limit=2, user_limit=5, download_limit=1, prefetch_limit=1)
+        await scheduler.acquire(None, Priority.PREFETCH)
+        # over the prefetch limit
+        with self.assertRaises(SlotUnavailable):
+            await scheduler.acquire(None, Priority.PREFETCH)
+        scheduler.release(None, Priority.PREFETCH)
+        await scheduler.acquire("a")
+        await scheduler.acquire("a")
+        waiter = asyncio.ensure_future(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        scheduler.release("a")
+        # the freed slot goes to the waiting page, not to a prefetch
+        with self.assertRaises(SlotUnavailable):
+            await scheduler.acquire(None, Priority.PREFETCH)
+        await asyncio.wait_for(waiter, 1)
+
+    async def test_user_over_limit_doesnt_block_others(self):
+        scheduler = UpstreamScheduler(limit=16, user_limit=2, download_limit=1)
+        await scheduler.acquire("a")
+        await scheduler.acquire("a")
+        waiter = asyncio.ensure_future(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.waiting, 1)
+        # the global slots are free, b and a prefetch run right away
+        await asyncio.wait_for(scheduler.acquire("b"), 0.01)
+        await scheduler.acquire(None, Priority.PREFETCH)
+        self.assertFalse(waiter.done())
+        scheduler.release("a")
+        await asyncio.wait_for(waiter, 1)
+
+    async def test_cancelled_waiter_is_removed(self):
+        scheduler = UpstreamScheduler(limit=1, user_limit=1, download_limit=1)
+        await scheduler.acquire("a")
+        waiter = asyncio.ensure_future(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.waiting, 0)
+        scheduler.release("a")
+        self.assertEqual(scheduler.active, 0)
+
+class UserMiddlewareTests(IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def update(user_id: int) -> SimpleNamespace:
+        from_user = SimpleNamespace(id=user_id, username=f"user{user_id}", full_name="Name", language_code="ru")
+        return SimpleNamespace(event=SimpleNamespace(from_user=from_user))
+
+    async def handler(self, update, data):
+        return "handled"
+
+    async def test_users_are_queued_once(self):
+        middleware = UserMiddleware(flush_size=100)
+        for user_id in (1, 2, 1, 1):
+            self.assertEqual(await middleware(self.handler, self.update(user_id), {}), "handled")
+        self.assertEqual(list(middleware.queue), [1, 2])
+
+    async def test_full_queue_is_flushed(self):
+        middleware = UserMiddleware(flush_size=2, flush_interval=60)
+        flushed = []
+
+        async def flush():
+            flushed.append(list(middleware.queue))
+            middleware.queue = {}
+
+        middleware.flush = flush
+        middleware.start()
+        try:
+            await middleware(self.handler, self.update(1), {})
+            await middleware(self.handler, self.update(2), {})
+            await asyncio.sleep(0.01)
+        finally:
+            await middleware.stop()
+        self.assertEqual(flushed[0], [1, 2])
+
+    async def test_stop_waits_for_a_running_flush(self):
+        middleware = UserMiddleware(flush_size=1, flush_interval=60, storage=None)
+        saved = []
+        writing = asyncio.Event()
+
+        async def flush():
+            if not middleware.queue:
+                return
+            batch, middleware.queue = middleware.queue, {}
+            writing.set()
+            await asyncio.sleep(0.05)
+            saved.extend(batch)
+
+        middleware.flush = flush
+        middleware.start()
+        await middleware(self.handler, self.update(1), {})
+        await writing.wait()
+        await middleware.stop()
+        self.assertEqual(saved, [1])
+
+class FileUsesTests(IsolatedAsyncioTestCase):
+
+    async def test_uses_are_counted_in_memory(self):
+        file_uses = FileUses(flush_interval=60)
+        for book in ((1, "fb2"), (1, "fb2"), (2, "epub")):
+            file_uses.record(*book)
+        self.assertEqual(file_uses.queue, {(1, "fb2"): 2, (2, "epub"): 1})
+
+    async def test_failed_flush_keeps_the_uses(self):
+        file_uses = FileUses(flush_interval=60)
+        file_uses.record(1, "fb2")
+        # the tests have no database
+        with self.assertLogs("Bot logger.db", "ERROR"):
+            await file_uses.flush()
+        file_uses.record(1, "fb2")
+        self.assertEqual(file_uses.queue, {(1, "fb2"): 2})
+
+class InstrumentedPoolTests(IsolatedAsyncioTestCase):
+
+    async def test_overflow_and_timeout_are_counted(self):
+        pool = InstrumentedPool(MagicMock, pool_size=1, max_overflow=1, timeout=0.01)
+        checkouts, overflows, timeouts = pool_stats.checkouts, pool_stats.overflows, pool_stats.timeouts
+        connections = [await greenlet_spawn(pool.connect) for _ in range(2)]
+        with self.assertRaises(PoolTimeoutError):
+            await greenlet_spawn(pool.connect)
+        self.assertEqual(pool.checkedout(), 2)
+        self.assertEqual(pool_stats.checkouts - checkouts, 2)
+        self.assertEqual(pool_stats.overflows - overflows, 1)
+        self.assertEqual(pool_stats.timeouts - timeouts, 1)
+        for connection in connections:
+            connection.close()
+
+def dump_fixtures(directory: str = os.path.join(FIXTURES, "sql")) -> dict:
+    return {table: os.path.join(directory, name.removesuffix(".gz")) for table, name in DUMPS.items()}
+
+class CatalogueTests(MockFlibustaTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.directory = tempfile.mkdtemp()
+        self._catalogue = Flibusta.catalogue
+        Flibusta.catalogue = Catalogue(os.path.join(self.directory, "catalogue.sqlite"))
+
+    async def asyncTearDown(self):
+        Flibusta.catalogue = self._catalogue
+        shutil.rmtree(self.directory)
+        await super().asyncTearDown()
+
+    def test_read_dump(self):
+        rows = [row for table, row in read_dump(dump_fixtures()["libbook"])]
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[-1]["Title"], "The 'Quoted' Title, (part 1)")
+        self.assertEqual(rows[-1]["BookId"], 807198)
+
+    async def test_search_is_answered_locally(self):
+        self.assertTrue(await Flibusta.refresh_catalogue())
+        requests = self.server.requests
+        search_page = await Flibusta.get_search_text("чехова")
+        self.assertEqual(self.server.requests, requests)
+        self.assertIn("Чехов Антон Павлович /a_10463", search_page.text())
+        self.assertIn("Вишнёвый сад /b_10501", search_page.text())
+        # ё, endings and prefixes
+        search_page = await Flibusta.get_search_text("вишневого сад")
+        self.assertEqual(search_page.dict, {"Найденные книги (1):": ["Вишнёвый сад /b_10501"]})
+
+    async def test_miss_falls_back_to_flibusta(self):
+        await Flibusta.refresh_catalogue()
+        requests = self.server.requests
+        search_page = await Flibusta.get_search_text("удаленная книга")
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertFalse(search_page.dict)
+
+    async def test_unchanged_dumps_are_skipped(self):
+        self.assertTrue(await Flibusta.refresh_catalogue())
+        self.assertFalse(await Flibusta.refresh_catalogue())
+
+    def test_incremental_refresh(self):
+        path = os.path.join(self.directory, "index.sqlite")
+        build_index(path, dump_fixtures())
+        dumps = dump_fixtures(self.directory)
+        for table, dump in dump_fixtures().items():
+            shutil.copy(dump, dumps[table])
+        with open(dumps["libbook"], encoding="utf-8") as file:
+            text = file.read()
+        with open(dumps["libbook"], "w", encoding="utf-8") as file:
+            file.write(text.replace("'Палата № 6','','ru','fb2',1892,'0'", "'Палата № 6','','ru','fb2',1892,'1'"))
+        build_index(path, dumps)
+        catalogue = Catalogue(path)
+        self.assertIsNone(catalogue.search_sync("палата"))
+        self.assertTrue(catalogue.search_sync("собачкой"))
+
+class PrefetcherTests(MockFlibustaTestCase):
+
+    async def wait(self, prefetcher: Prefetcher):
+        await asyncio.gather(*prefetcher._tasks.values())
+
+    async def test_first_links_are_prefetched(self):
+        prefetcher = Prefetcher(top=2, rate=0, burst=10)
+        prefetcher.prefetch_links(["/b_531326", "/a_18862", "/b_10501"], user_id=1)
+        await self.wait(prefetcher)
+        self.assertEqual(self.server.requests, 2)
+        requests = self.server.requests
+        await Flibusta.get_page("/a_18862")
+        self.assertEqual(self.server.requests, requests)
+
+    async def test_budget(self):
+        prefetcher = Prefetcher(top=5, rate=0, burst=1)
+        prefetcher.prefetch_links(["/b_531326", "/b_10501"], user_id=1)
+        await self.wait(prefetcher)
+        self.assertEqual(self.server.requests, 1)
+
+    async def test_next_answer_cancels_prefetch(self):
+        self.server.delay = 0.05
+        prefetcher = Prefetcher(top=5, rate=0, burst=10)
+        prefetcher.prefetch_links(["/b_531326", "/b_10501", "/b_807198"], user_id=1)
+        await asyncio.sleep(0.01)
+        prefetcher.prefetch_links([], user_id=1)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.server.requests, 1)
+        await prefetcher.stop()
+
+    async def test_busy_scheduler_skips_prefetch(self):
+        prefetcher = Prefetcher(top=5, rate=0, burst=10)
+        for _ in range(Flibusta.scheduler.limit):
+            await Flibusta.scheduler.acquire()
+        try:
+            prefetcher.prefetch_links(["/b_531326"], user_id=1)
+            await self.wait(prefetcher)
+        finally:
+            for _ in range(Flibusta.scheduler.limit):
+                Flibusta.scheduler.release()
+        self.assertEqual(self.server.requests, 0)
+
+    async def test_failed_job_doesnt_end_the_batch(self):
+        prefetcher = Prefetcher(top=5, rate=0, burst=10)
+        done = []
+
+        async def broken_page():
+            raise IndexError("odd page")
+
+        async def page():
+            done.append(True)
+
+        with self.assertLogs("Bot logger.prefetch", "ERROR"):
+            prefetcher._start(1, [broken_page, page])
+            await self.wait(prefetcher)
+        self.assertEqual(done, [True])
+
+    async def test_warm_up_waits_for_budget(self):
+        prefetcher = Prefetcher(top=1, rate=50, burst=1)
+        prefetcher.warm_up(["/b_531326", "/b_10501", "/b_807198"])
+        await self.wait(prefetcher)
+        self.assertEqual(self.server.requests, 3)
+
+    async def test_format_check(self):
+        prefetcher = Prefetcher(top=5, rate=0, burst=10, check_formats=True)
+        book_page = await Flibusta.get_page("/b_10501")
+        prefetcher.prefetch_formats(book_page, user_id=1)
+        await self.wait(prefetcher)
+        self.assertEqual(set(prefetcher.formats), {(10501, link.split("/")[-1]) for link in book_page.links})
+        self.assertEqual(prefetcher.format_size(10501, "fb2"), book_page.size * 1024)
+
+    async def test_page_links(self):
+        search_page = await Flibusta.get_search_text("чехов")
+        self.assertEqual(search_page.page_links(0)[:2], ["/a_10463", "/a_30121"])
+        self.assertEqual(len(search_page.page_links(0)), SearchPage.page_size)
+        author_page = await Flibusta.get_page("/a_10463")
+        self.assertEqual(author_page.page_links(1)[0], author_page.books[AuthorPage.page_size][1])
+
+class InlineSearchTests(MockFlibustaTestCase):
+
+    async def test_superseded_query_is_dropped(self):
+        inline_search = InlineSearch(debounce=0.05, budget=5)
+        first = asyncio.ensure_future(inline_search.search("чех", user_id=1))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(inline_search.search("чехов", user_id=1))
+        self.assertIsNone(await first)
+        self.assertTrue((await second).dict)
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(inline_search.superseded, 1)
+
+    async def test_other_users_are_not_superseded(self):
+        inline_search = InlineSearch(debounce=0.05, budget=5)
+        pages = await asyncio.gather(inline_search.search("чехов", user_id=1), inline_search.search("чехов", user_id=2))
+        self.assertTrue(all(page is not None for page in pages))
+
+    async def test_longer_query_is_filtered_from_prefix(self):
+        inline_search = InlineSearch(debounce=0, budget=5)
+        inline_search._pages["чехо"] = SearchPage.from_results({
+            "Найденные писатели (3):": [
+                "Чехов Антон Павлович /a_10463", "Чехов Михаил Павлович /a_30121", "Чехова Мария Павловна /a_48812",
+            ],
+        })
+        search_page = await inline_search.search("Чехов  ант")
+        self.assertEqual(search_page.dict, {"Найденные писатели (3):": ["Чехов Антон Павлович /a_10463"]})
+        self.assertEqual(self.server.requests, 0)
+
+    async def test_empty_prefix_filter_asks_the_search(self):
+        inline_search = InlineSearch(debounce=0, budget=5)
+        inline_search._pages["вишневого"] = SearchPage.from_results({"Найденные книги (1):": ["Вишнёвый сад /b_10501"]})
+        await inline_search.search("вишневого с")
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(inline_search.prefix_hits, 0)
+        # the empty answer is not kept
+        self.assertNotIn("вишневого с", inline_search._pages)
+
+    async def test_results_expire(self):
+        inline_search = InlineSearch(debounce=0, budget=5, ttl=0.05)
+        await inline_search.search("чехов")
+        await asyncio.sleep(0.1)
+        Flibusta.cache.clear()
+        await inline_search.search("чехов")
+        self.assertEqual(self.server.requests, 2)
+
+    async def test_truncated_results_are_not_filtered(self):
+        inline_search = InlineSearch(debounce=0, budget=5)
+        await inline_search.search("чехов")
+        await inline_search.search("чехов антон")
+        self.assertEqual(self.server.requests, 2)
+
+    async def test_latency_budget(self):
+        self.server.delay = 0.5
+        inline_search = InlineSearch(debounce=0, budget=0.1)
+        with self.assertRaises(asyncio.TimeoutError):
+            await inline_search.search("чехов")
+        self.assertEqual(inline_search.timeouts, 1)
+
+    def test_results_are_paginated(self):
+        page = SearchPage.from_results({"Найденные книги (120):": [f"Книга {num} /b_{num}" for num in range(120)]})
+        results, next_offset = inline_results(page)
+        self.assertEqual((len(results), next_offset), (50, "50"))
+        self.assertEqual((results[0].id, results[0].title, results[0].description), ("/b_0", "Книга 0", "Найденные книги"))
+        self.assertEqual(results[0].input_message_content.message_text, "/b_0")
+        results, next_offset = inline_results(page, 100)
+        self.assertEqual((len(results), next_offset), (20, ""))
+
+class MemoryProfilerTests(IsolatedAsyncioTestCase):
+
+    def test_rss_and_objects(self):
+        self.assertGreater(rss_bytes(), 0)
+        counts = object_counts(top=3)
+        self.assertEqual(len(counts), 3)
+        self.assertGreaterEqual(counts[0][1], counts[1][1])
+
+    async def test_report_shows_growth(self):
+        profiler = MemoryProfiler(trace=True, interval=0, top=5)
+        profiler.start()
+        try:
+            grown = [bytearray(1024) for _ in range(1000)]
+            report = profiler.report(objects=True)
+        finally:
+            await profiler.stop()
+        self.assertIn("RSS:", report)
+        self.assertIn("grown since the last report:", report)
+        self.assertIn("tests.py", report)
+        self.assertIn("objects by type:", report)
+        self.assertEqual(len(grown), 1000)
+
+    async def test_interval_report(self):
+        profiler = MemoryProfiler(trace=False, interval=0.01)
+        with self.assertLogs("Bot logger.memory", "INFO") as logs:
+            profiler.start()
+            try:
+                await asyncio.sleep(0.2)
+            finally:
+                await profiler.stop()
+        self.assertIn("RSS:", logs.output[0])
+
+class MetricsTests(MockFlibustaTestCase):
+
+    def test_render(self):
+        test_registry = Registry()
+        requests = test_registry.counter("requests_total", "Requests", labels=("handler",))
+        latency = test_registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+        test_registry.callback("queue", "Queue", lambda: 3)
+        requests.inc(handler="search_handler")
+        requests.inc(handler="search_handler")
+        latency.observe(0.05)
+        latency.observe(0.1)
+        latency.observe(5)
+        text = test_registry.render()
+        self.assertIn('requests_total{handler="search_handler"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn("latency_seconds_count 3", text)
+        self.assertIn("queue 3", text)
+
+    async def test_fetch_is_measured(self):
+        before = fetch_seconds.count(operation="page")
+        await Flibusta.get_page("/b_531326")
+        self.assertEqual(fetch_seconds.count(operation="page"), before + 1)
 
-    def test_search_page_non_exist(self):
-        self.assertFalse(self.search_page_non_exist.dict)
+    async def test_metrics_endpoint(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        runner = await start_metrics_server("127.0.0.1", port)
+        try:
+            async with ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    text = await response.text()
+        finally:
+            await runner.cleanup()
+        self.assertIn("# TYPE flibusta_fetch_seconds histogram", text)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file